@@ -0,0 +1,102 @@
+from bisect import insort, bisect_left
+from random import randint, seed
+from time import perf_counter
+
+from AsyncDB.Allocator import Allocator
+
+# 存活区间数，替换次数
+LIVE = 20000
+N = 200000
+SIZES = ((16, 256), (16, 4096), (16, 65536))
+
+
+class LegacyAllocator:
+    # 原SizeQue/SizeMap实现，作为对照
+    def __init__(self, max_len=1024):
+        self.max_len = max_len
+        self.size_que = []
+        self.size_map = {}
+        self.ptr_map = {}
+
+    def malloc(self, size: int) -> int:
+        index = bisect_left(self.size_que, size)
+        if index < len(self.size_que):
+            size_exist = self.size_que[index]
+            ptrs = self.size_map[size_exist]
+            ptr = ptrs.pop()
+            if not ptrs:
+                del self.size_map[size_exist]
+                del self.size_que[index]
+            del self.ptr_map[ptr]
+            self.free(ptr + size, size_exist - size)
+            return ptr
+
+    def free(self, ptr: int, size: int):
+        if size == 0:
+            return
+        tail_ptr = ptr + size
+        while tail_ptr in self.ptr_map:
+            tail_size = self.ptr_map.pop(tail_ptr)
+            ptrs = self.size_map[tail_size]
+            del ptrs[bisect_left(ptrs, tail_ptr)]
+            if not ptrs:
+                del self.size_map[tail_size]
+                del self.size_que[bisect_left(self.size_que, tail_size)]
+            tail_ptr += tail_size
+        size = tail_ptr - ptr
+
+        if size in self.size_map:
+            if len(self.size_map[size]) < self.max_len:
+                self.ptr_map[ptr] = size
+                insort(self.size_map[size], ptr)
+        else:
+            insort(self.size_que, size)
+            size_remove = self.size_que.pop(0) if len(self.size_que) > self.max_len else None
+            if size_remove == size:
+                return
+            self.ptr_map[ptr] = size
+            self.size_map[size] = [ptr]
+            if size_remove:
+                for ptr in self.size_map.pop(size_remove):
+                    del self.ptr_map[ptr]
+
+
+def run(allocator, lo: int, hi: int) -> dict:
+    # 保持LIVE个区间，每次随机释放一个并分配一个新长度
+    seed(0)
+    live = []
+    end = 0
+
+    def malloc(size: int):
+        nonlocal end
+        ptr = allocator.malloc(size)
+        if ptr is None:
+            ptr = end
+            end += size
+        live.append((ptr, size))
+
+    for _ in range(LIVE):
+        malloc(randint(lo, hi))
+    begin_end = end
+    begin = perf_counter()
+    for _ in range(N):
+        i = randint(0, len(live) - 1)
+        live[i], live[-1] = live[-1], live[i]
+        allocator.free(*live.pop())
+        malloc(randint(lo, hi))
+    elapsed = perf_counter() - begin
+
+    used = sum(size for _, size in live)
+    free = sum(allocator.ptr_map.values())
+    return {'ops/s': round(2 * N / elapsed), 'growth': round(end / begin_end, 2),
+            'free': free, 'lost': end - used - free}
+
+
+def main():
+    for lo, hi in SIZES:
+        for name, allocator in (('legacy', LegacyAllocator()), ('new', Allocator())):
+            print('%d-%d' % (lo, hi), name, run(allocator, lo, hi))
+
+
+if __name__ == '__main__':
+    main()
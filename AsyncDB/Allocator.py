@@ -1,91 +1,155 @@
-from bisect import insort, bisect_left
-from collections import UserList, UserDict
-
-
-class SizeQue(UserList):
-    def __init__(self, max_len=1024):
-        super().__init__()
-        self.max_len = max_len
-
-    def append(self, size: int) -> int:
-        insort(self.data, size)
-        if len(self.data) > self.max_len:
-            return self.data.pop(0)
-
-    def find(self, size: int) -> int:
-        # 默认非空
-        index = bisect_left(self.data, size)
-        if index < len(self.data):
-            return index
-
-
-class SizeMap(UserDict):
-    def discard(self, size: int) -> int:
-        ptrs = self.data.get(size)
-        if ptrs:
-            ptr = ptrs.pop()
-            if not ptrs:
-                del self.data[size]
-            return ptr
+from bisect import bisect_left, insort
+from contextlib import suppress
+from os import rename
+from struct import pack, unpack, Struct
+
+# 文件头: magic, generation, 区间数
+FREE_HEAD = Struct('<4sQI')
+FREE_MAGIC = b'FREE'
+# 每个2的幂区间再等分为1 << SL_BITS组
+SL_BITS = 4
+SL_NUM = 1 << SL_BITS
 
-    def add(self, size: int, ptr: int):
-        ptrs = self.data.setdefault(size, [])
-        insort(ptrs, ptr)
+
+def bin_index(size: int) -> int:
+    # 两级分组: 小于2 * SL_NUM时每个长度一组，否则按最高位与其后SL_BITS位分组
+    shift = size.bit_length() - 1 - SL_BITS
+    return size if shift <= 0 else (shift << SL_BITS) + (size >> shift)
 
 
 class Allocator:
+    # 分组查找最小的足够大区间(best-fit) + 前后合并，空闲区间全部保留
     def __init__(self):
-        # size_que: [..., size]
-        self.size_que = SizeQue()
-        # size_map: {..., size: [..., ptr]}
-        self.size_map = SizeMap()
+        # bins: {..., index: [..., (size, ptr)]}，组内有序，同长度时低地址优先
+        self.bins = {}
+        # 非空组的位图
+        self.bitmap = 0
         # ptr_map: {..., ptr: size}
         self.ptr_map = {}
+        # end_map: {..., ptr + size: ptr}
+        self.end_map = {}
+        self.size = 0
+
+    def insert(self, ptr: int, size: int):
+        index = bin_index(size)
+        extents = self.bins.get(index)
+        if extents is None:
+            self.bins[index] = [(size, ptr)]
+            self.bitmap |= 1 << index
+        else:
+            insort(extents, (size, ptr))
+        self.ptr_map[ptr] = size
+        self.end_map[ptr + size] = ptr
+        self.size += size
+
+    def remove(self, ptr: int) -> int:
+        size = self.ptr_map.pop(ptr)
+        del self.end_map[ptr + size]
+        index = bin_index(size)
+        extents = self.bins[index]
+        if len(extents) == 1:
+            del self.bins[index]
+            self.bitmap ^= 1 << index
+        else:
+            del extents[bisect_left(extents, (size, ptr))]
+        self.size -= size
+        return size
+
+    def find(self, size: int) -> tuple:
+        # 返回最小的足够大区间所在的(组, 组内位置)，不存在返回None
+        index = bin_index(size)
+        # size所在组中可能有足够大的区间，均小于之后各组
+        extents = self.bins.get(index)
+        if extents:
+            i = bisect_left(extents, (size, 0))
+            if i < len(extents):
+                return index, i
+        # 此后第一个非空组的首个区间
+        higher = self.bitmap >> index + 1
+        if higher:
+            return index + (higher & -higher).bit_length(), 0
 
     def malloc(self, size: int) -> int:
-        if self.size_que:
-            index = self.size_que.find(size)
-            if index is not None:
-                size_exist = self.size_que[index]
-                ptr = self.size_map.discard(size_exist)
-                if size_exist not in self.size_map:
-                    del self.size_que[index]
-                del self.ptr_map[ptr]
-                # 空间写回
-                self.free(ptr + size, size_exist - size)
-                return ptr
+        found = self.find(size)
+        if found is not None:
+            index, i = found
+            extents = self.bins[index]
+            extent, ptr = extents.pop(i)
+            if not extents:
+                del self.bins[index]
+                self.bitmap ^= 1 << index
+            del self.ptr_map[ptr]
+            del self.end_map[ptr + extent]
+            self.size -= extent
+            # 空间写回
+            if extent > size:
+                self.insert(ptr + size, extent - size)
+            return ptr
 
     def free(self, ptr: int, size: int):
         assert size >= 0
         if size == 0:
             return
 
-        # 检测是否合并
-        tail_ptr = ptr + size
-        while tail_ptr in self.ptr_map:
-            tail_size = self.ptr_map.pop(tail_ptr)
-            ptrs = self.size_map[tail_size]
-            del ptrs[bisect_left(ptrs, tail_ptr)]
-            if not self.size_map[tail_size]:
-                del self.size_map[tail_size]
-                del self.size_que[self.size_que.find(tail_size)]
-            tail_ptr += tail_size
-        size = tail_ptr - ptr
-
-        if size in self.size_map:
-            if len(self.size_map[size]) < self.size_que.max_len:
-                self.ptr_map[ptr] = size
-                self.size_map.add(size, ptr)
+        # 与前后相邻的区间合并
+        end = ptr + size
+        if end in self.ptr_map:
+            end += self.remove(end)
+        head = self.end_map.get(ptr)
+        if head is not None:
+            self.remove(head)
+            ptr = head
+        self.insert(ptr, end - ptr)
+
+    def stats(self) -> dict:
+        # fragmentation: 1 - 最大区间 / 空闲总量
+        largest = self.bins[self.bitmap.bit_length() - 1][-1][0] if self.bitmap else 0
+        return {'free_bytes': self.size, 'extents': len(self.ptr_map), 'largest': largest,
+                'fragmentation': 1 - largest / self.size if self.size else 0}
+
+    def extents(self) -> list:
+        return sorted(self.ptr_map.items())
+
+    def dump(self, filename: str, gen: int):
+        # 先写临时文件再替换
+        extents = self.extents()
+        temp = filename + '$'
+        with open(temp, 'wb') as file:
+            file.write(FREE_HEAD.pack(FREE_MAGIC, gen, len(extents)))
+            file.write(pack('<%dQ' % (2 * len(extents)), *(num for extent in extents for num in extent)))
+        rename(temp, filename)
+
+    @staticmethod
+    def load(filename: str):
+        # 返回(generation, [..., (ptr, size)])，格式不符返回None
+        with suppress(Exception), open(filename, 'rb') as file:
+            magic, gen, num = FREE_HEAD.unpack(file.read(FREE_HEAD.size))
+            if magic == FREE_MAGIC:
+                nums = unpack('<%dQ' % (2 * num), file.read(16 * num))
+                return gen, list(zip(nums[::2], nums[1::2]))
+
+
+def subtract_extents(extents: list, ranges: list) -> list:
+    # 从有序不相交的extents中去除ranges覆盖的部分
+    merged = []
+    for ptr, size in sorted(ranges):
+        if merged and ptr <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], ptr + size)
         else:
-            size_remove = self.size_que.append(size)
-            if size_remove == size:
-                return
-            # 未被移除
-            else:
-                self.ptr_map[ptr] = size
-                self.size_map.add(size, ptr)
-            # 溢出
-            if size_remove:
-                for ptr in self.size_map[size_remove]:
-                    del self.ptr_map[ptr]
-                del self.size_map[size_remove]
+            merged.append([ptr, ptr + size])
+
+    result = []
+    i = 0
+    for ptr, size in extents:
+        end = ptr + size
+        while i < len(merged) and merged[i][1] <= ptr:
+            i += 1
+        j = i
+        while j < len(merged) and merged[j][0] < end:
+            if merged[j][0] > ptr:
+                result.append((ptr, merged[j][0] - ptr))
+            ptr = max(ptr, merged[j][1])
+            j += 1
+        if ptr < end:
+            result.append((ptr, end - ptr))
+    return result
@@ -1,45 +1,249 @@
-from collections import UserDict
+from asyncio import CancelledError, Queue, ensure_future, get_event_loop, shield
+from collections import deque
 
-from .Engine import Engine
+from .BulkLoader import FILL_FACTOR
+from .Engine import Engine, COMPACT_RATE, INLINE_SIZE, MEMTABLE_SIZE, MIN_DEGREE, NODE_CACHE_SIZE, NONE, POP, settle
+from .Node import COMPRESS_SIZE
+from .TaskQue import MVCC_SIZE, SnapshotTooOld
+from .ValueCache import ValueCache, MISSING, NOT_CACHED
 
+VALUE_CACHE_SIZE = 16 * 1024 * 1024
 
-class Cache(UserDict):
-    def __init__(self, max_len=128):
-        super().__init__()
-        self.max_len = max_len
+
+class WriteBatch:
+    # 收集set/pop，commit时作为一个Task执行
+    def __init__(self, db: 'AsyncDB'):
+        self.db = db
+        self.items = {}
 
     def __setitem__(self, key, value):
-        self.data[key] = value
-        if len(self.data) > self.max_len:
-            self.data.popitem()
+        self.items[key] = value
+
+    def pop(self, key):
+        self.items[key] = POP
+
+    def commit(self):
+        if self.items:
+            self.db.write(self.items)
+            self.items = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+
+
+class Scan:
+    # 分页流式遍历，每页各自使用一个读Task，后台预取不超过prefetch页，至少1页
+    # 后台任务不引用Scan，未close即丢弃时由__del__取消
+    def __init__(self, engine: Engine, item_from, item_to, reverse: bool, after, page_size: int, prefetch: int):
+        self.engine = engine
+        self.item_from = item_from
+        self.item_to = item_to
+        self.reverse = reverse
+        self.page_size = page_size
+        # Queue(0)不限长度
+        self.que = Queue(max(prefetch, 1))
+        self.page = deque()
+        self.producer = None
+        self.is_done = False
+        # 最后返回的key，传入scan(after=...)可继续
+        self.continuation = after
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    async def __anext__(self):
+        while not self.page:
+            if self.is_done:
+                raise StopAsyncIteration
+            if self.producer is None:
+                self.producer = ensure_future(Scan.produce(self.engine, self.que, self.item_from, self.item_to,
+                                                           self.reverse, self.continuation, self.page_size))
+            page = await self.que.get()
+            if isinstance(page, Exception):
+                self.is_done = True
+                raise page
+            elif page is None:
+                self.is_done = True
+            else:
+                self.page.extend(page)
+        item = self.page.popleft()
+        self.continuation = item[0]
+        return item
+
+    @staticmethod
+    async def produce(engine: Engine, que: Queue, item_from, item_to, reverse: bool, after, page_size: int):
+        try:
+            while True:
+                lo, hi = item_from, item_to
+                if after is not None:
+                    if reverse:
+                        hi = after
+                    else:
+                        lo = after
+                # 多取一项，排除after本身；取消时读Task仍需完成，中止时重试本页
+                try:
+                    page = await shield(engine.items(lo, hi, page_size + 1, reverse))
+                except SnapshotTooOld:
+                    continue
+                is_last = len(page) <= page_size
+                if page and after is not None and page[0][0] == after:
+                    del page[0]
+                else:
+                    del page[page_size:]
+                if page:
+                    await que.put(page)
+                    after = page[-1][0]
+                if is_last:
+                    await que.put(None)
+                    return
+        except Exception as e:
+            await que.put(e)
+
+    def close(self):
+        if self.producer is not None and not self.producer.done():
+            self.producer.cancel()
+        self.is_done = True
 
 
 class AsyncDB:
-    def __init__(self, filename: str):
-        self.cache = Cache()
-        self.engine = Engine(filename)
+    def __init__(self, filename: str, node_cache_size=NODE_CACHE_SIZE, use_mmap=False, inline_size=INLINE_SIZE,
+                 use_bloom=False, value_cache_size=VALUE_CACHE_SIZE, metrics=True, min_degree=MIN_DEGREE,
+                 compression=None, compress_size=COMPRESS_SIZE, value_dict: bytes = None, durability=NONE,
+                 memtable_size=MEMTABLE_SIZE, mvcc_size=MVCC_SIZE):
+        self.cache = ValueCache(value_cache_size)
+        # 进行中的读取: {..., key: (ticket, future)}
+        self.flights = {}
+        # min_degree仅在新建文件时使用，已有文件以文件头为准
+        self.engine = Engine(filename, node_cache_size, use_mmap, inline_size, use_bloom, metrics, min_degree,
+                             compression, compress_size, value_dict, durability, memtable_size, mvcc_size)
 
     def __getitem__(self, key):
         async def coro():
-            return self.cache[key] if key in self.cache else await self.engine.get(key)
+            value = self.cache.get(key)
+            if value is NOT_CACHED:
+                # 同一key的并发读取共享一次查询，期间有写入则ticket作废，之后的读取另行查询
+                ticket = self.cache.ticket(key)
+                flight = self.flights.get(key)
+                if flight and flight[0] is ticket:
+                    try:
+                        return await shield(flight[1])
+                    except CancelledError:
+                        # 首个读取被取消不影响等待者，另行查询
+                        if not flight[1].cancelled():
+                            raise
+                        return await coro()
+                # 由首个读取直接执行，读Task在调用时创建
+                future = get_event_loop().create_future()
+                self.flights[key] = (ticket, future)
+                try:
+                    value = await self.engine.get(key)
+                except BaseException as e:
+                    settle(future, e)
+                    raise
+                finally:
+                    if self.flights.get(key) == (ticket, future):
+                        del self.flights[key]
+                future.set_result(value)
+                # 读取期间被写入则不填充，引擎不区分不存在与None，均记为不存在
+                self.cache.put(key, MISSING if value is None else value, ticket)
+            return None if value is MISSING else value
 
         return coro()
 
+    async def get_many(self, keys) -> list:
+        # 缓存未命中的key一次遍历查询，结果与keys顺序一致
+        keys = list(keys)
+        values = [self.cache.get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is NOT_CACHED]
+        if missing:
+            tickets = [self.cache.ticket(key) for key in missing]
+            found = await self.engine.get_many(missing)
+            for key, ticket, value in zip(missing, tickets, found):
+                self.cache.put(key, MISSING if value is None else value, ticket)
+            found = dict(zip(missing, found))
+            values = [found[key] if value is NOT_CACHED else value for key, value in zip(keys, values)]
+        return [None if value is MISSING else value for value in values]
+
     def __setitem__(self, key, value):
-        if key in self.cache and self.cache[key] == value:
+        # 仅与缓存中存在的值相同时跳过
+        cached = self.cache.peek(key)
+        if cached is not NOT_CACHED and cached is not MISSING and cached == value:
             return
-        self.cache[key] = value
+        self.cache.put(key, value)
         self.engine.set(key, value)
 
     def pop(self, key):
-        if key in self.cache:
-            del self.cache[key]
+        # 删除后记为不存在
+        self.cache.put(key, MISSING)
         return self.engine.pop(key)
 
+    def write_batch(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def set_many(self, items):
+        self.write(dict(items))
+
+    def write(self, items: dict):
+        for key, value in items.items():
+            self.cache.put(key, MISSING if value is POP else value)
+        self.engine.write_batch(items)
+
+    def flush(self):
+        # 写缓冲立即写入树
+        self.engine.flush()
+
+    async def sync(self):
+        # 此前的set/pop/write落盘后返回，durability为none时立即返回
+        await self.engine.durable()
+
+    def bulk_load(self, items, fill=FILL_FACTOR):
+        # 仅用于空数据库，items需按key严格递增
+        self.cache.clear()
+        self.engine.bulk_load(items, fill)
+
+    @staticmethod
+    def build(filename: str, items, inline_size=INLINE_SIZE, fill=FILL_FACTOR, min_degree=MIN_DEGREE,
+              compression=None, compress_size=COMPRESS_SIZE, value_dict: bytes = None):
+        # 离线构建，filename不能已存在
+        Engine.build(filename, items, inline_size, fill, min_degree, compression, compress_size, value_dict)
+
+    async def compact(self, rate=COMPACT_RATE, fill=FILL_FACTOR, min_degree=None):
+        # 在线整理，rate为每秒复制的字节数上限，可同时改变min_degree
+        await self.engine.compact(rate, fill=fill, min_degree=min_degree)
+
     async def items(self, item_from=None, item_to=None, max_len=0, reverse=False):
         return await self.engine.items(item_from, item_to, max_len, reverse)
 
+    def scan(self, item_from=None, item_to=None, reverse=False, after=None, page_size=128, prefetch=2) -> Scan:
+        return Scan(self.engine, item_from, item_to, reverse, after, page_size, prefetch)
+
+    def cache_stats(self) -> dict:
+        return self.cache.stats()
+
+    def metrics(self) -> dict:
+        result = self.engine.snapshot()
+        result['value_cache'] = self.cache.stats()
+        return result
+
+    def on_metric(self, callback):
+        # callback(name, seconds)，每次计时的操作完成时调用
+        self.engine.metrics.hooks.append(callback)
+
     async def close(self):
+        self.engine.flush()
         if self.engine.task_que.que:
             await self.engine.lock.acquire()
             await self.engine.lock.acquire()
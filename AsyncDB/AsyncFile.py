@@ -1,9 +1,16 @@
-from asyncio import get_event_loop
+from asyncio import get_event_loop, gather
 from collections import deque
 from collections.abc import Callable
 from concurrent.futures import ThreadPoolExecutor
+from mmap import mmap, ACCESS_READ
+from os import fstat
 from os.path import getsize
 
+try:
+    from os import pwrite, pwritev
+except ImportError:
+    pwritev = None
+
 loop = get_event_loop()
 
 
@@ -18,55 +25,175 @@ class FastIO:
 
     def read(self, offset: int, length: int):
         self.seek(offset)
-        self.cursor = offset + length
-        return self.file.read(length)
+        # 文件末尾可能不足length
+        data = self.file.read(length)
+        self.cursor = offset + len(data)
+        return data
 
     def write(self, offset: int, data: bytes):
         self.seek(offset)
         self.cursor = offset + len(data)
         self.file.write(data)
 
+    def writev(self, offset: int, datas: list):
+        # 不改变文件指针
+        if pwritev:
+            size = pwritev(self.file.fileno(), datas, offset)
+            total = sum(map(len, datas))
+            if size < total:
+                data = b''.join(datas)[size:]
+                while data:
+                    size = pwrite(self.file.fileno(), data, offset + total - len(data))
+                    data = data[size:]
+        else:
+            self.write(offset, b''.join(datas))
+
     def exec(self, offset: int, action: Callable):
+        # action失败时文件指针同样需要同步
         self.seek(offset)
-        result = action(self.file)
-        self.cursor = self.file.tell()
-        return result
+        try:
+            return action(self.file)
+        finally:
+            self.cursor = self.file.tell()
 
 
 class AsyncFile:
-    def __init__(self, filename: str, io_num=4):
+    def __init__(self, filename: str, io_num=4, use_mmap=False):
         self.size = getsize(filename)
         self.executor = ThreadPoolExecutor(io_num)
         self.io_que = deque((FastIO(filename) for _ in range(io_num)), io_num)
+        # 读写统计
+        self.read_num = 0
+        self.read_size = 0
+        self.write_num = 0
+        self.write_size = 0
+        # 等待执行及执行中的I/O数
+        self.pending = 0
+        self.pending_max = 0
+
+        # 只读映射，在事件循环内直接读取
+        self.map_file = open(filename, 'rb') if use_mmap else None
+        self.map = None
+        self.map_view = None
+        if use_mmap:
+            self.remap()
+
+    def remap(self):
+        # 文件增长后重新映射
+        size = fstat(self.map_file.fileno()).st_size
+        if size and (self.map is None or size > len(self.map)):
+            self.map = mmap(self.map_file.fileno(), size, access=ACCESS_READ)
+            self.map_view = memoryview(self.map)
+
+    def view(self, offset: int, length: int) -> memoryview:
+        # 未启用映射或超出文件返回None
+        if self.map_file is None:
+            return
+        if self.map is None or offset + length > len(self.map):
+            self.remap()
+            if self.map is None or offset + length > len(self.map):
+                return
+        self.read_num += 1
+        self.read_size += length
+        return self.map_view[offset:offset + length]
+
+    async def run(self, async_call: Callable, *args):
+        self.pending += 1
+        if self.pending > self.pending_max:
+            self.pending_max = self.pending
+        try:
+            return await loop.run_in_executor(self.executor, async_call, *args)
+        finally:
+            self.pending -= 1
 
     async def read(self, offset: int, length: int):
         def async_call():
             io = self.io_que.pop()
-            result = io.read(offset, length)
-            self.io_que.append(io)
-            return result
-
-        return await loop.run_in_executor(self.executor, async_call)
+            try:
+                return io.read(offset, length)
+            finally:
+                self.io_que.append(io)
+
+        result = await self.run(async_call)
+        self.read_num += 1
+        self.read_size += len(result)
+        return result
 
     async def write(self, offset: int, data: bytes):
         assert self.size >= offset + len(data)
 
         def async_call():
             io = self.io_que.pop()
-            io.write(offset, data)
-            self.io_que.append(io)
+            try:
+                io.write(offset, data)
+            finally:
+                self.io_que.append(io)
+
+        await self.run(async_call)
+        self.write_num += 1
+        self.write_size += len(data)
 
-        await loop.run_in_executor(self.executor, async_call)
+    async def writev(self, offset: int, datas: list):
+        size = sum(map(len, datas))
+        assert self.size >= offset + size
+
+        def async_call():
+            io = self.io_que.pop()
+            try:
+                io.writev(offset, datas)
+            finally:
+                self.io_que.append(io)
+
+        await self.run(async_call)
+        self.write_num += 1
+        self.write_size += size
 
     async def exec(self, offset: int, action: Callable):
+        # 读取长度由执行后的位置得到
         def async_call():
+            # 出错时同样归还io
             io = self.io_que.pop()
-            result = io.exec(offset, action)
-            self.io_que.append(io)
-            return result
+            try:
+                return io.exec(offset, action), io.cursor - offset
+            finally:
+                self.io_que.append(io)
+
+        result, size = await self.run(async_call)
+        self.read_num += 1
+        self.read_size += size
+        return result
 
-        return await loop.run_in_executor(self.executor, async_call)
+    async def exec_many(self, offsets: list, action: Callable) -> list:
+        # 按偏移排序后分为至多io_num组，每组一次线程切换
+        def async_call(chunk: list):
+            io = self.io_que.pop()
+            result = []
+            size = 0
+            try:
+                for offset in chunk:
+                    result.append(io.exec(offset, action))
+                    size += io.cursor - offset
+            finally:
+                self.io_que.append(io)
+            return result, size
+
+        offsets = sorted(offsets)
+        step = -(-len(offsets) // self.io_que.maxlen)
+        chunks = await gather(*(self.run(async_call, offsets[i:i + step]) for i in range(0, len(offsets), step)))
+        self.read_num += len(offsets)
+        self.read_size += sum(size for _, size in chunks)
+        return [result for chunk, _ in chunks for result in chunk]
+
+    def stats(self) -> dict:
+        return {'reads': self.read_num, 'read_bytes': self.read_size,
+                'writes': self.write_num, 'write_bytes': self.write_size,
+                'pending': self.pending, 'pending_max': self.pending_max}
 
     def close(self):
         for io in self.io_que:
             io.file.close()
+        if self.map_file is not None:
+            if self.map is not None:
+                self.map_view.release()
+                self.map.close()
+            self.map_file.close()
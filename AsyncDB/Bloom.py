@@ -0,0 +1,79 @@
+from contextlib import suppress
+from hashlib import sha1
+from struct import pack, unpack_from, Struct
+
+# magic, hash数, 容量, add次数, pop次数
+BLOOM_HEAD = Struct('<4sBQQQ')
+BLOOM_MAGIC = b'BLOM'
+# 每key 10 bit，7个hash，误判率约1%
+BITS_PER_KEY = 10
+HASH_NUM = 7
+BLOOM_MIN = 1 << 16
+
+
+def encode_key(key) -> bytes:
+    # 相等的key编码相同，无法保证时返回None
+    if isinstance(key, str):
+        return b's' + key.encode('utf-8', 'surrogatepass')
+    elif isinstance(key, (bytes, bytearray)):
+        return b'b' + bytes(key)
+    elif isinstance(key, float):
+        if not key.is_integer():
+            return b'f' + repr(key).encode()
+        return b'i' + str(int(key)).encode()
+    elif isinstance(key, int):
+        return b'i' + str(int(key)).encode()
+    elif isinstance(key, tuple):
+        items = [encode_key(item) for item in key]
+        if any(item is None for item in items):
+            return
+        return b't' + b''.join(pack('<I', len(item)) + item for item in items)
+
+
+class Bloom:
+    # 只增不减，pop只计数，过期后由Engine重建
+    def __init__(self, capacity=BLOOM_MIN):
+        self.capacity = capacity
+        self.bit_num = capacity * BITS_PER_KEY
+        self.bits = bytearray((self.bit_num + 7) // 8)
+        self.num = 0
+        self.pops = 0
+
+    def positions(self, data: bytes):
+        h1, h2 = unpack_from('<QQ', sha1(data).digest())
+        for i in range(HASH_NUM):
+            yield (h1 + i * h2) % self.bit_num
+
+    def add(self, key):
+        self.num += 1
+        data = encode_key(key)
+        if data is not None:
+            for pos in self.positions(data):
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key) -> bool:
+        data = encode_key(key)
+        if data is None:
+            return True
+        return all(self.bits[pos >> 3] & 1 << (pos & 7) for pos in self.positions(data))
+
+    def is_stale(self) -> bool:
+        return self.num > self.capacity or self.pops > self.capacity // 2
+
+    def dump(self, filename: str):
+        with open(filename, 'wb') as file:
+            file.write(BLOOM_HEAD.pack(BLOOM_MAGIC, HASH_NUM, self.capacity, self.num, self.pops))
+            file.write(self.bits)
+
+    @staticmethod
+    def load(filename: str) -> 'Bloom':
+        # 格式不符返回None
+        with suppress(Exception), open(filename, 'rb') as file:
+            magic, hash_num, capacity, num, pops = BLOOM_HEAD.unpack(file.read(BLOOM_HEAD.size))
+            bloom = Bloom(capacity)
+            bits = file.read()
+            if magic == BLOOM_MAGIC and hash_num == HASH_NUM and len(bits) == len(bloom.bits):
+                bloom.bits[:] = bits
+                bloom.num = num
+                bloom.pops = pops
+                return bloom
@@ -0,0 +1,162 @@
+from heapq import merge
+from pickle import dump, dumps, load
+from tempfile import TemporaryFile
+
+from .Node import IndexNode, ValueNode
+
+# 节点填充率
+FILL_FACTOR = 0.9
+# 缓冲写入长度
+FLUSH_SIZE = 1024 * 1024
+# 外部排序每段的项数
+RUN_SIZE = 1 << 18
+
+
+class BulkLoader:
+    # 由有序数据自底向上构建B-Tree，顺序写入file
+    # 每层只保留未成形的节点，剩余项足够组成合法节点时才输出
+    def __init__(self, file, offset: int, degree: int, inline_size=0, fill=FILL_FACTOR, codec=None):
+        self.file = file
+        self.offset = offset
+        self.buffer = bytearray()
+        self.degree = degree
+        self.inline_size = inline_size
+        self.codec = codec
+        # 每节点的key数，不少于degree - 1
+        self.cap = min(2 * degree - 1, max(degree - 1, round(fill * (2 * degree - 1))))
+        # levels: [..., (keys, values, ptrs_child)]，0为叶节点层
+        self.levels = []
+        self.num = 0
+        self.last_key = None
+
+    def write(self, data: bytes) -> int:
+        ptr = self.offset + len(self.buffer)
+        self.buffer += data
+        if len(self.buffer) >= FLUSH_SIZE:
+            self.flush()
+        return ptr
+
+    def flush(self):
+        if self.buffer:
+            self.file.seek(self.offset)
+            self.file.write(self.buffer)
+            self.offset += len(self.buffer)
+            self.buffer = bytearray()
+
+    def make_value(self, key, value, is_leaf: bool):
+        if is_leaf and self.inline_size:
+            data = dumps(value)
+            if len(data) < self.inline_size:
+                return data
+        return self.write(bytes(ValueNode(key, value, codec=self.codec)))
+
+    def make_node(self, is_leaf: bool, keys: list, values: list, ptrs_child: list) -> IndexNode:
+        node = IndexNode(is_leaf=is_leaf)
+        node.keys = keys
+        node.ptrs_value = [self.make_value(key, value, is_leaf) for key, value in zip(keys, values)]
+        if not is_leaf:
+            node.ptrs_child = ptrs_child
+        node.ptr = self.write(bytes(node))
+        return node
+
+    def add(self, key, value):
+        assert self.num == 0 or self.last_key < key
+        self.num += 1
+        self.last_key = key
+        self.push(0, key, value, None)
+
+    def push(self, level: int, key, value, ptr_child):
+        if level == len(self.levels):
+            self.levels.append(([], [], []))
+        keys, values, ptrs_child = self.levels[level]
+        if ptr_child is not None:
+            ptrs_child.append(ptr_child)
+        keys.append(key)
+        values.append(value)
+
+        # 输出后剩余 >= degree
+        cap = self.cap
+        if len(keys) >= cap + 1 + self.degree:
+            node = self.make_node(level == 0, keys[:cap], values[:cap], ptrs_child[:cap + 1])
+            mid_key = keys[cap]
+            mid_value = values[cap]
+            del keys[:cap + 1]
+            del values[:cap + 1]
+            del ptrs_child[:cap + 1]
+            self.push(level + 1, mid_key, mid_value, node.ptr)
+
+    def finish(self) -> IndexNode:
+        # 由下至上，每层剩余项组成1或2个节点，返回root
+        if not self.levels:
+            node = self.make_node(True, [], [], [])
+            self.flush()
+            return node
+
+        level = 0
+        while True:
+            keys, values, ptrs_child = self.levels[level]
+            is_leaf = level == 0
+            is_top = level == len(self.levels) - 1
+            if len(keys) <= 2 * self.degree - 1:
+                node = self.make_node(is_leaf, keys, values, ptrs_child)
+                if is_top:
+                    break
+                self.levels[level + 1][2].append(node.ptr)
+            else:
+                mi = len(keys) // 2
+                left = self.make_node(is_leaf, keys[:mi], values[:mi], ptrs_child[:mi + 1])
+                right = self.make_node(is_leaf, keys[mi + 1:], values[mi + 1:], ptrs_child[mi + 1:])
+                if is_top:
+                    self.levels.append(([], [], []))
+                par_keys, par_values, par_ptrs_child = self.levels[level + 1]
+                par_ptrs_child.extend((left.ptr, right.ptr))
+                par_keys.append(keys[mi])
+                par_values.append(values[mi])
+            level += 1
+        self.flush()
+        return node
+
+
+def sort_items(file, run_size=RUN_SIZE):
+    # 外部排序pickle序列中的(key, value)，key相同时保留最后一项
+    def read_run(run_file):
+        run_file.seek(0)
+        while True:
+            try:
+                yield load(run_file)
+            except EOFError:
+                run_file.close()
+                return
+
+    def sort_key(item):
+        return item[0], item[1]
+
+    runs = []
+    seq = 0
+    is_end = False
+    while not is_end:
+        run = []
+        while len(run) < run_size:
+            try:
+                key, value = load(file)
+            except EOFError:
+                is_end = True
+                break
+            run.append((key, seq, value))
+            seq += 1
+        run.sort(key=sort_key)
+        if is_end and not runs:
+            runs.append(run)
+        elif run:
+            run_file = TemporaryFile()
+            for item in run:
+                dump(item, run_file)
+            runs.append(read_run(run_file))
+
+    last = None
+    for item in merge(*runs, key=sort_key):
+        if last is not None and last[0] != item[0]:
+            yield last[0], last[2]
+        last = item
+    if last is not None:
+        yield last[0], last[2]
@@ -1,70 +1,321 @@
-from asyncio import ensure_future, Lock
-from bisect import insort, bisect, bisect_left
-from collections import UserList
+from asyncio import CancelledError, ensure_future, gather, get_event_loop, shield, sleep, Lock
+from bisect import bisect, bisect_left
+from collections import deque
+from heapq import heappush, heappop
 from contextlib import suppress
-from os import remove, rename
+from os import remove, rename, urandom
 from os.path import getsize, isfile
-from pickle import load, dump, UnpicklingError
-from struct import pack, unpack
+from pickle import dump, dumps, load, loads
+from struct import pack, unpack, Struct
+from time import perf_counter
 
-from .Allocator import Allocator
+from .Allocator import Allocator, subtract_extents
+from .Bloom import Bloom, BLOOM_MIN
+from .BulkLoader import BulkLoader, FILL_FACTOR, sort_items
 from .AsyncFile import AsyncFile
-from .Node import IndexNode, ValueNode
-from .TaskQue import TaskQue, Task
-
-
-class SortedList(UserList):
-    def append(self, item):
-        insort(self.data, item)
+from .MemTable import MemTable, POP
+from .Metrics import Metrics, SAMPLE_RATE
+from .Node import IndexNode, ValueCodec, ValueNode, COMPRESS_SIZE, INLINE, NODE_HEAD, NODE_VERSION, VALUE_HEAD
+from .NodeCache import NodeCache
+from .RedoLog import RedoLog, fdatasync, MEM_PTR
+from .TaskQue import TaskQue, Task, SnapshotTooOld, MVCC_SIZE
 
 
 OP = b'\x00'
 ED = b'\x01'
+LEAF = pack('B', NODE_VERSION)
+# 新建文件的默认值，及无几何记录的旧文件所用值
 MIN_DEGREE = 64
+# 文件头: indicator, root地址, 之后为页面几何: magic, min_degree
+GEOMETRY = Struct('<4sI')
+GEOMETRY_MAGIC = b'GEOM'
+HEAD_SIZE = 9 + GEOMETRY.size
+# 单次合并写入的命令上限
+IOV_MAX = 1024
+NODE_CACHE_SIZE = 64 * 1024 * 1024
+# 小于此长度的值内联于叶节点，0为不内联
+INLINE_SIZE = 0
+# 重建filter时每次读取的key数
+BLOOM_PAGE = 1024
+# 写入队列排空且日志超过此长度时截断
+REDO_SIZE = 4 * 1024 * 1024
+# 整理时每秒复制的字节数上限，0为不限
+COMPACT_RATE = 16 * 1024 * 1024
+# 整理时每次读取的项数
+COMPACT_PAGE = 128
+# 追平写入的轮数上限，剩余部分替换后同步执行
+COMPACT_ROUNDS = 8
+# 持久化: 不调用fdatasync / 多个Task共用一次fdatasync / 每个Task提交时同步fdatasync
+NONE, GROUP, STRICT = 'none', 'group', 'strict'
+# group模式下一次fdatasync前的最长等待及最多Task数
+GROUP_DELAY = 0.002
+GROUP_COMMITS = 64
+# 写缓冲的字节数上限，0为不使用
+MEMTABLE_SIZE = 0
+# 写缓冲写入树时的日志记录
+CLEAR = dumps(None)
+
+
+def new_generation() -> int:
+    return unpack('Q', urandom(8))[0]
+
+
+def write_head(file, ptr: int, min_degree: int):
+    assert min_degree >= 2
+    file.write(OP)
+    file.write(pack('Q', ptr))
+    file.write(GEOMETRY.pack(GEOMETRY_MAGIC, min_degree))
+
+
+def read_geometry(file) -> (int, int):
+    # 返回(min_degree, 文件头长度)，旧文件的root紧接于root地址之后
+    file.seek(9)
+    data = file.read(GEOMETRY.size)
+    if len(data) == GEOMETRY.size:
+        magic, min_degree = GEOMETRY.unpack(data)
+        if magic == GEOMETRY_MAGIC:
+            return min_degree, HEAD_SIZE
+    return MIN_DEGREE, 9
+
+
+def load_dictionaries(filename: str) -> list:
+    # 压缩字典保存于filename + '.dict'，丢失后以其压缩的值无法读取
+    with suppress(OSError), open(filename + '.dict', 'rb') as file:
+        return load(file)
+    return []
+
+
+def make_codec(filename: str, compression=None, compress_size=COMPRESS_SIZE, value_dict: bytes = None) -> ValueCodec:
+    # 新字典追加保存并启用zdict
+    dictionaries = load_dictionaries(filename)
+    if value_dict:
+        compression = compression or 'zdict'
+        if value_dict in dictionaries:
+            dictionaries.remove(value_dict)
+        dictionaries.append(value_dict)
+        with open(filename + '.dict.tmp', 'wb') as file:
+            dump(dictionaries, file)
+        rename(filename + '.dict.tmp', filename + '.dict')
+    return ValueCodec(compression, compress_size, dictionaries)
+
+
+def settle(future, error: BaseException):
+    # 共享的读取失败时通知其余等待者，无等待者时不报告
+    # 首个读取被取消时共享结果随之取消，等待者据此另行读取，不会收到CancelledError
+    if isinstance(error, CancelledError):
+        future.cancel()
+    else:
+        future.set_exception(error)
+        future.exception()
 
 
 class BasicEngine:
     # 基础事务
-    def __init__(self, filename: str):
+    # 值的压缩设置
+    codec = None
+    # 写缓冲，由Engine创建
+    memtable = None
+
+    def __init__(self, filename: str, cache_size=NODE_CACHE_SIZE, use_mmap=False, min_degree=MIN_DEGREE,
+                 durability=NONE, mvcc_size=MVCC_SIZE):
+        assert durability in (NONE, GROUP, STRICT)
+        self.filename = filename
+        self.durability = durability
+        redo_file = filename + '.redo'
+        self.free_file = filename + '.free'
+        # 已知的空闲空间，None时遍历树重建
+        extents = []
+        # 重做得到的写缓冲记录
+        self.mem_records = []
         if not isfile(filename):
             with open(filename, 'wb') as file:
-                # indicator
-                file.write(OP)
-                # root
-                file.write(pack('Q', 9))
+                write_head(file, HEAD_SIZE, min_degree)
+                self.min_degree, self.head_size = min_degree, HEAD_SIZE
                 self.root = IndexNode(is_leaf=True)
                 self.root.dump(file)
         else:
             with open(filename, 'rb+') as file:
-                if file.read(1) == OP:
-                    file.close()
-                    return BasicEngine.repair(filename)
-                else:
-                    ptr = unpack('Q', file.read(8))[0]
-                    file.seek(ptr)
-                    self.root = IndexNode(file=file)
-                    file.seek(0)
-                    file.write(OP)
+                # 以文件记录的几何为准
+                self.min_degree, self.head_size = read_geometry(file)
+                saved = Allocator.load(self.free_file)
+                file.seek(0)
+                is_closed = file.read(1) != OP
+                if not is_closed:
+                    # 非正常关闭，由redo日志恢复，日志不存在时扫描修复
+                    replayed = RedoLog.replay(file, redo_file)
+                    if replayed is None:
+                        file.close()
+                        return BasicEngine.repair(filename)
+                    # 与日志同一generation的空闲空间，去除重做写入的部分后可用
+                    gen, ranges, self.mem_records = replayed
+                    if saved and gen is not None and saved[0] == gen:
+                        extents = subtract_extents(saved[1], ranges)
+                    else:
+                        extents = None
+
+                file.seek(1)
+                ptr = unpack('Q', file.read(8))[0]
+                if is_closed:
+                    # 正常关闭时generation为root地址，防止误用其他文件的记录
+                    extents = saved[1] if saved and saved[0] == ptr else None
+                file.seek(ptr)
+                # root常驻内存并直接修改
+                self.root = IndexNode(file=file).clone()
+                file.seek(0)
+                file.write(OP)
 
         self.allocator = Allocator()
-        self.async_file = AsyncFile(filename)
-        self.command_que = SortedList()
+        self.async_file = AsyncFile(filename, use_mmap=use_mmap)
+        # command_que: heap of (ptr, token, data, depend)
+        self.command_que = []
+        self.que_depth_max = 0
+        self.command_num = 0
+        # Task内同步写入的字节数
+        self.sync_write_size = 0
+        # 分配统计: 复用空闲空间/追加至文件末尾
+        self.malloc_reused = 0
+        self.malloc_appended = 0
         self.file = open(filename, 'rb+', buffering=0)
+        if extents is None:
+            extents = self.walk_extents()
+        size = self.async_file.size
+        for ptr, length in extents:
+            # 超出文件末尾的部分丢弃
+            length = min(length, size - ptr)
+            if length > 0:
+                self.allocator.free(ptr, length)
+        # 先保存空闲空间，再以同一generation截断日志
+        gen = new_generation()
+        self.allocator.dump(self.free_file, gen)
+        self.redo = RedoLog(redo_file, gen)
+        # 已落盘的redo记录数，等待落盘: [..., (seq, future)]
+        self.synced_seq = 0
+        self.sync_waiters = deque()
+        self.sync_task = None
+        self.sync_wake = None
+        # 当前Task的同步写入: [..., (ptr, data)]
+        self.redo_writes = []
         self.lock = Lock()
+        self.node_cache = NodeCache(cache_size)
+        # 读取中的节点: {..., ptr: (ticket, future)}
+        self.node_reads = {}
         self.on_interval = (0, 1)
         self.on_write = False
-        self.task_que = TaskQue()
+        # 旧版本超出mvcc_size字节时中止最早的读Task
+        self.task_que = TaskQue(self.free, mvcc_size)
+
+    def walk_extents(self) -> list:
+        # 遍历树得到已用空间，其余即为空闲
+        used = [(0, self.head_size)]
+        stack = [self.root.ptr]
+        while stack:
+            self.file.seek(stack.pop())
+            node = IndexNode(file=self.file)
+            used.append((node.ptr, node.size))
+            for ptr in node.ptrs_value:
+                if isinstance(ptr, int):
+                    self.file.seek(ptr)
+                    size = ValueNode.size_of(self.file.read(VALUE_HEAD.size))
+                    if not size:
+                        # 旧格式需完整读取
+                        self.file.seek(ptr)
+                        size = ValueNode(file=self.file).size
+                    used.append((ptr, size))
+            if not node.is_leaf:
+                stack.extend(node.ptrs_child)
+        return subtract_extents([(self.head_size, self.async_file.size - self.head_size)], used)
+
+    def checkpoint(self):
+        # 写入全部完成时保存空闲空间，截断日志
+        if self.durability != NONE:
+            # 截断前数据文件先落盘
+            fdatasync(self.file.fileno())
+        gen = new_generation()
+        self.allocator.dump(self.free_file, gen)
+        self.redo.truncate(gen)
+        self.log_memtable()
+        if self.durability != NONE:
+            self.redo.sync()
+            self.synced(self.redo.seq)
+
+    def log_memtable(self):
+        # 截断后的日志需重新记录未写入树的缓冲
+        if self.memtable:
+            self.redo.append([(MEM_PTR, self.memtable.dumps())])
+
+    def log(self, writes: list):
+        # 追加一条redo记录，按durability落盘
+        self.redo.append(writes)
+        if self.durability == STRICT:
+            self.redo.sync()
+            self.synced(self.redo.seq)
+        elif self.durability == GROUP:
+            if self.sync_task is None:
+                self.sync_task = ensure_future(self.group_sync())
+            elif self.redo.seq - self.synced_seq >= GROUP_COMMITS and self.sync_wake and not self.sync_wake.done():
+                self.sync_wake.set_result(None)
+
+    def durable(self):
+        # 返回future，此前提交的写入落盘后完成，none模式立即完成
+        future = get_event_loop().create_future()
+        if self.durability == NONE or self.synced_seq >= self.redo.seq:
+            future.set_result(None)
+        else:
+            self.sync_waiters.append((self.redo.seq, future))
+            if self.sync_task is None:
+                self.sync_task = ensure_future(self.group_sync())
+        return future
+
+    def synced(self, seq: int):
+        self.synced_seq = seq
+        while self.sync_waiters and self.sync_waiters[0][0] <= seq:
+            _, future = self.sync_waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+
+    async def group_sync(self):
+        # 等待GROUP_DELAY或GROUP_COMMITS个Task后一次fdatasync，期间提交的Task共用
+        def wake(future):
+            if not future.done():
+                future.set_result(None)
+
+        loop = get_event_loop()
+        redo = self.redo
+        try:
+            while redo is self.redo and self.synced_seq < redo.seq:
+                if self.durability == GROUP and redo.seq - self.synced_seq < GROUP_COMMITS:
+                    self.sync_wake = loop.create_future()
+                    handle = loop.call_later(GROUP_DELAY, wake, self.sync_wake)
+                    await self.sync_wake
+                    handle.cancel()
+                seq = redo.seq
+                await loop.run_in_executor(None, redo.sync)
+                # 整理替换了文件时由整理完成等待
+                if redo is self.redo:
+                    self.synced(seq)
+        except (OSError, ValueError) as e:
+            # 关闭后的日志不再需要落盘
+            if redo is self.redo and not self.redo.file.closed:
+                while self.sync_waiters:
+                    settle(self.sync_waiters.popleft()[1], e)
+        finally:
+            if redo is self.redo:
+                self.sync_task = None
+                self.sync_wake = None
 
     def malloc(self, size: int) -> int:
         def is_inside(ptr: int) -> bool:
             begin, end = self.on_interval
-            return begin <= ptr <= end or begin <= ptr + size <= end
+            return ptr <= end and begin <= ptr + size
 
         ptr = self.allocator.malloc(size)
         if ptr and is_inside(ptr):
             self.free(ptr, size)
             ptr = 0
-        if not ptr:
+        if ptr:
+            self.malloc_reused += 1
+        else:
+            self.malloc_appended += 1
             ptr = self.async_file.size
             self.async_file.size += size
         return ptr
@@ -72,18 +323,113 @@ class BasicEngine:
     def free(self, ptr: int, size: int):
         self.allocator.free(ptr, size)
 
+    def write(self, ptr: int, data: bytes):
+        # Task内的同步写入，随Task记入redo日志
+        self.file.seek(ptr)
+        self.file.write(data)
+        self.sync_write_size += len(data)
+        self.redo_writes.append((ptr, data))
+
+    def map_node(self, ptr: int) -> IndexNode:
+        # 从映射直接解码，不可用时返回None
+        head = self.async_file.view(ptr, NODE_HEAD.size)
+        size = head is not None and IndexNode.size_of(head)
+        if size:
+            data = self.async_file.view(ptr, size)
+            if data is not None:
+                # 空间可能被复用，复制一份
+                node = IndexNode()
+                node.loads(ptr, bytes(data))
+                return node
+
+    def map_value(self, ptr: int) -> ValueNode:
+        head = self.async_file.view(ptr, VALUE_HEAD.size)
+        size = head is not None and ValueNode.size_of(head)
+        if size:
+            data = self.async_file.view(ptr, size)
+            if data is not None:
+                val = ValueNode(codec=self.codec)
+                val.loads(ptr, data)
+                return val
+
+    async def read_node(self, ptr: int) -> IndexNode:
+        # 只读，结果可能为共享对象
+        node = self.node_cache.get(ptr)
+        if node is None:
+            node = self.map_node(ptr)
+            if node is not None:
+                self.node_cache.put(ptr, node)
+            else:
+                # 同一ptr的并发读取共享一次I/O，ptr被写入或释放后ticket作废，之后的读取另行进行
+                ticket = self.node_cache.ticket(ptr)
+                flight = self.node_reads.get(ptr)
+                if flight and flight[0] is ticket:
+                    try:
+                        return await shield(flight[1])
+                    except CancelledError:
+                        # 首个读取被取消不影响等待者，另行读取
+                        if not flight[1].cancelled():
+                            raise
+                        return await self.read_node(ptr)
+                future = get_event_loop().create_future()
+                self.node_reads[ptr] = (ticket, future)
+                try:
+                    node = await self.async_file.exec(ptr, lambda f: IndexNode(file=f))
+                except BaseException as e:
+                    settle(future, e)
+                    raise
+                finally:
+                    if self.node_reads.get(ptr) == (ticket, future):
+                        del self.node_reads[ptr]
+                future.set_result(node)
+                self.node_cache.put(ptr, node, ticket)
+        return node
+
+    async def read_value(self, ptr: int) -> ValueNode:
+        return self.map_value(ptr) or await self.async_file.exec(ptr, lambda f: ValueNode(file=f, codec=self.codec))
+
+    async def read_values(self, ptrs: list) -> list:
+        # 按偏移批量读取，结果与ptrs顺序一致
+        vals = {}
+        missing = []
+        for ptr in set(ptrs):
+            val = self.map_value(ptr)
+            if val:
+                vals[ptr] = val
+            else:
+                missing.append(ptr)
+        if missing:
+            for val in await self.async_file.exec_many(missing, lambda f: ValueNode(file=f, codec=self.codec)):
+                vals[val.ptr] = val
+        return [vals[ptr] for ptr in ptrs]
+
+    def fetch_node(self, ptr: int) -> IndexNode:
+        # 同步读取，结果可修改
+        node = self.node_cache.get(ptr)
+        if node is None:
+            self.file.seek(ptr)
+            node = IndexNode(file=self.file)
+            self.node_cache.put(ptr, node)
+        return node.clone()
+
     def time_travel(self, token: Task, node: IndexNode):
+        if token.is_aborted:
+            raise SnapshotTooOld
+        # 只查询存在映射的地址
+        virtual_map = self.task_que.virtual_map
         address = node.nth_value_ads(0)
         for i in range(len(node.ptrs_value)):
-            ptr = self.task_que.get(token, address, node.ptr)
-            if ptr:
-                node.ptrs_value[i] = ptr
+            if address in virtual_map and isinstance(node.ptrs_value[i], int):
+                ptr = self.task_que.get(token, address, node.ptr)
+                if ptr:
+                    node.ptrs_value[i] = ptr
             address += 8
         if not node.is_leaf:
             for i in range(len(node.ptrs_child)):
-                ptr = self.task_que.get(token, address, node.ptr)
-                if ptr:
-                    node.ptrs_child[i] = ptr
+                if address in virtual_map:
+                    ptr = self.task_que.get(token, address, node.ptr)
+                    if ptr:
+                        node.ptrs_child[i] = ptr
                 address += 8
 
     def a_command_done(self, token: Task):
@@ -95,142 +441,810 @@ class BasicEngine:
 
     # cum = cumulation
     def do_cum(self, token: Task, free_nodes, command_map):
+        freed = set()
+        superseded = []
         for node in free_nodes:
-            self.free(node.ptr, node.size)
+            # 新root分裂前未分配空间
+            if not node.ptr:
+                continue
+            self.node_cache.discard(node.ptr)
+            freed.add(node.ptr)
+            # 本Task内分配又释放，无需写入
+            if command_map.pop(node.ptr, None) is not None:
+                self.free(node.ptr, node.size)
+            # 旧读取可能仍在进行，Task清理时释放
+            else:
+                token.free_params.append((node.ptr, node.size))
+                if node.has_inline():
+                    superseded.append(node.ptr)
+        commands = []
         for ptr, param in command_map.items():
             data, depend = param if isinstance(param, tuple) else (param, 0)
+            if depend in freed:
+                continue
+            # 含内联值的叶节点同ValueNode一样同步写入，repair时不会缺失
+            if len(data) > 8 and data[1] & INLINE and data[0] == NODE_VERSION:
+                self.write(ptr, data)
+            else:
+                commands.append((ptr, data, depend))
+        # 新叶节点写入后标记被取代的叶节点，只改动状态字节，进行中的读取不受影响
+        for ptr in superseded:
+            self.write(ptr + NODE_HEAD.size, pack('B', 0))
+
+        # 先记录再写入
+        writes = self.redo_writes
+        writes.extend((ptr, data) for ptr, data, _ in commands)
+        if writes:
+            self.log(writes)
+        self.redo_writes = []
+        for ptr, data, depend in commands:
             self.ensure_write(token, ptr, data, depend)
         self.time_travel(token, self.root)
         self.root = self.root.clone()
+        # 无写入的Task不会被a_command_done清理
+        if token.command_num == 0:
+            token.command_num += 1
+            self.a_command_done(token)
 
     def ensure_write(self, token: Task, ptr: int, data: bytes, depend=0):
+        def is_canceled(command) -> bool:
+            ptr, token, _, depend = command
+            return depend and self.task_que.is_canceled(token, depend) or self.task_que.is_canceled(token, ptr)
+
+        def command_done(command):
+            ptr, token, _, depend = command
+            self.node_cache.unpin(ptr)
+            if depend:
+                self.node_cache.unpin(depend)
+            self.a_command_done(token)
+
         async def coro():
             while self.command_que:
-                ptr, token, data, depend = self.command_que.pop(0)
-                cancel = depend and self.task_que.is_canceled(token, depend)
-                if not cancel:
-                    cancel = self.task_que.is_canceled(token, ptr)
-                if not cancel:
-                    # 确保边界不相连
-                    self.on_interval = (ptr - 1, ptr + len(data) + 1)
-                    await self.async_file.write(ptr, data)
-                self.a_command_done(token)
+                command = heappop(self.command_que)
+                if is_canceled(command):
+                    command_done(command)
+                    continue
+
+                # 合并相邻命令
+                run = [command]
+                begin = command[0]
+                end = begin + len(command[2])
+                while self.command_que and self.command_que[0][0] == end and len(run) < IOV_MAX:
+                    command = heappop(self.command_que)
+                    if is_canceled(command):
+                        command_done(command)
+                        break
+                    run.append(command)
+                    end += len(command[2])
+
+                # 确保边界不相连
+                self.on_interval = (begin - 1, end + 1)
+                # 先写日志: 记录落盘后才可覆盖数据文件
+                if self.synced_seq < self.redo.seq and self.durability != NONE:
+                    await self.durable()
+                if len(run) == 1:
+                    await self.async_file.write(begin, run[0][2])
+                else:
+                    await self.async_file.writev(begin, [command[2] for command in run])
+                self.command_num += len(run)
+                for command in run:
+                    command_done(command)
             self.on_write = False
+            # 已记录的写入全部完成
+            if self.redo.size >= REDO_SIZE:
+                self.checkpoint()
 
         if not self.on_write:
             self.on_write = True
             ensure_future(coro())
         # 按ptr和token.id排序
-        self.command_que.append((ptr, token, data, depend))
+        heappush(self.command_que, (ptr, token, data, depend))
+        self.que_depth_max = max(self.que_depth_max, len(self.command_que))
         token.command_num += 1
+        # 写入前缓存不可用
+        self.node_cache.pin(ptr)
+        if depend:
+            self.node_cache.pin(depend)
+
+    async def drain(self):
+        # 等待所有Task完成，返回后至下一次await前无进行中的Task
+        while self.task_que.que:
+            await self.lock.acquire()
+            await self.lock.acquire()
+            self.lock.release()
+
+    def write_stats(self) -> dict:
+        write_num = self.async_file.write_num
+        return {'que_depth': len(self.command_que), 'que_depth_max': self.que_depth_max,
+                'commands': self.command_num, 'syscalls': write_num, 'bytes': self.async_file.write_size,
+                'bytes_per_syscall': self.async_file.write_size / write_num if write_num else 0,
+                'sync_bytes': self.sync_write_size, 'redo_bytes': self.redo.write_size}
+
+    def written(self) -> int:
+        # 写入数据文件及redo日志的总字节数
+        return self.async_file.write_size + self.sync_write_size + self.redo.write_size
+
+    def allocator_stats(self) -> dict:
+        result = self.allocator.stats()
+        result.update(reused=self.malloc_reused, appended=self.malloc_appended, file_size=self.async_file.size)
+        return result
 
     def close(self):
+        self.allocator.dump(self.free_file, self.root.ptr)
         self.file.seek(0)
         self.file.write(ED)
+        if self.durability != NONE:
+            fdatasync(self.file.fileno())
+            self.synced(self.redo.seq)
         self.file.close()
+        self.redo.close()
         self.async_file.close()
 
     @staticmethod
     def repair(filename: str):
         temp = '__' + filename
         size = getsize(filename)
+        # 字典压缩的值需要已保存的字典
+        codec = ValueCodec(dictionaries=load_dictionaries(filename))
         with open(filename, 'rb') as file, open('$' + temp, 'wb') as items:
-            file.seek(9)
-            while file.tell() != size:
+            _, ptr = read_geometry(file)
+            while ptr < size:
+                file.seek(ptr)
                 indicator = file.read(1)
-                if indicator != ED:
-                    continue
-                with suppress(EOFError, UnpicklingError):
-                    item = load(file)
-                    if isinstance(item, tuple) and len(item) == 2:
-                        dump(item, items)
+                if indicator == ED:
+                    val = BasicEngine.scan_value(file, ptr, size, codec)
+                    if val:
+                        dump((val.key, val.value), items)
+                        ptr += val.size
+                        continue
+                elif indicator == LEAF:
+                    leaf = BasicEngine.scan_leaf(file, ptr, size)
+                    if leaf:
+                        # 已被取代的叶节点整体跳过，其中的内联值不会被误认为旧格式的ValueNode
+                        file.seek(ptr + NODE_HEAD.size)
+                        if file.read(1) == ED:
+                            for key, value in zip(leaf.keys, leaf.ptrs_value):
+                                if isinstance(value, bytes):
+                                    dump((key, loads(value)), items)
+                        ptr += leaf.size
+                        continue
+                ptr += 1
         rename('$' + temp, temp)
 
+    @staticmethod
+    def scan_value(file, ptr: int, size: int, codec: ValueCodec = None) -> ValueNode:
+        # 尝试在ptr处解析ValueNode，失败返回None
+        file.seek(ptr)
+        head = file.read(VALUE_HEAD.size)
+        with suppress(Exception):
+            length = ValueNode.size_of(head)
+            val = ValueNode(codec=codec)
+            if length:
+                if length > size - ptr:
+                    return
+                val.loads(ptr, head + file.read(length - VALUE_HEAD.size))
+            else:
+                file.seek(ptr)
+                val.load(file)
+            return val
+
+    @staticmethod
+    def scan_leaf(file, ptr: int, size: int) -> IndexNode:
+        # 只解析含内联值的叶节点，由crc校验
+        file.seek(ptr)
+        head = file.read(NODE_HEAD.size)
+        with suppress(Exception):
+            if head[1] & (INLINE | 1) == INLINE | 1:
+                length = IndexNode.size_of(head)
+                if length > size - ptr:
+                    return
+                leaf = IndexNode()
+                leaf.loads(ptr, head + file.read(length - NODE_HEAD.size))
+                return leaf
+
 
 class Engine(BasicEngine):
     # B-Tree核心
-    def __init__(self, filename: str):
+    # 启用metrics时每次计时的批量操作，get/set/pop在方法内抽样
+    TIMED = ('get_many', 'items', 'write_batch', 'flush', 'compact')
+
+    def __init__(self, filename: str, cache_size=NODE_CACHE_SIZE, use_mmap=False, inline_size=INLINE_SIZE,
+                 use_bloom=False, metrics=True, min_degree=MIN_DEGREE, compression=None, compress_size=COMPRESS_SIZE,
+                 value_dict: bytes = None, durability=NONE, memtable_size=MEMTABLE_SIZE, mvcc_size=MVCC_SIZE):
+        self.inline_size = inline_size
+        # set/write_batch先写入缓冲，达到memtable_size字节时按key顺序写入树
+        self.memtable = MemTable()
+        self.memtable_size = memtable_size
+        self.flush_num = 0
+        # compression: None/'zlib'/'lzma'/'bz2'/'zdict'，只影响之后写入的值
+        self.codec = make_codec(filename, compression, compress_size, value_dict)
+        # get次数及其经过的非root节点数
+        self.get_num = 0
+        self.get_visits = 0
+        self.metrics = Metrics()
+        if metrics:
+            # 仅在实例上包装，未启用时无额外开销
+            for name in Engine.TIMED:
+                setattr(self, name, self.metrics.timed(name, getattr(self, name)))
+        # get/set/pop的倒数，减至0的调用计时，未启用时从0减为负数不会抽中
+        self.get_left = self.set_left = self.pop_left = SAMPLE_RATE if metrics else 0
+        # 整理期间的写入: {..., key: value OR POP}
+        self.compact_log = None
+        # 整理替换前的截止点，其后的读取等待替换，写入仅进入缓冲
+        self.gate = None
+        # bloom: 可用的filter，bloom_next: 重建中的filter
+        self.bloom = None
+        self.bloom_next = None
+        self.bloom_task = None
+        self.bloom_file = filename + '.bloom'
+        if isfile(self.bloom_file):
+            # 仅正常关闭后有效，读取后删除
+            if use_bloom and Engine.is_closed(filename):
+                self.bloom = Bloom.load(self.bloom_file)
+            remove(self.bloom_file)
+        if use_bloom and not isfile(filename):
+            self.bloom = Bloom()
+
         temp = '__' + filename
         if not isfile(temp):
-            super().__init__(filename)
+            super().__init__(filename, cache_size, use_mmap, min_degree, durability, mvcc_size)
 
         if isfile(temp):
             if isfile(filename):
+                # 修复后沿用原文件的几何
+                with open(filename, 'rb') as file:
+                    min_degree, _ = read_geometry(file)
                 remove(filename)
 
-            super().__init__(filename)
+            super().__init__(filename, cache_size, use_mmap, min_degree, durability, mvcc_size)
+            if use_bloom:
+                self.bloom = Bloom()
             with open(temp, 'rb') as items:
+                self.bulk_load(sort_items(items))
+            remove(temp)
+
+        # 重做得到的缓冲不在截断后的日志中，立即写入树
+        for data in self.mem_records:
+            self.memtable.load(data)
+        self.mem_records = []
+        self.flush()
+
+        if use_bloom and self.bloom is None:
+            self.rebuild_bloom()
+
+    @staticmethod
+    def build(filename: str, items, inline_size=INLINE_SIZE, fill=FILL_FACTOR, min_degree=MIN_DEGREE,
+              compression=None, compress_size=COMPRESS_SIZE, value_dict: bytes = None):
+        # 由有序items离线构建新文件
+        assert not isfile(filename)
+        codec = make_codec(filename, compression, compress_size, value_dict)
+        with open(filename, 'wb') as file:
+            write_head(file, 0, min_degree)
+            loader = BulkLoader(file, HEAD_SIZE, min_degree, inline_size, fill, codec)
+            for key, value in items:
+                loader.add(key, value)
+            root = loader.finish()
+            file.seek(0)
+            file.write(ED)
+            file.write(pack('Q', root.ptr))
+
+    def bulk_load(self, items, fill=FILL_FACTOR):
+        # 仅用于空树，有序items写入文件末尾后一次性替换root
+        assert not self.root.keys and not self.memtable and self.compact_log is None
+        loader = BulkLoader(self.file, self.async_file.size, self.min_degree, self.inline_size, fill, self.codec)
+        for key, value in items:
+            loader.add(key, value)
+            self.bloom_add(key)
+        root = loader.finish()
+        self.async_file.size = loader.offset
+        if self.durability != NONE:
+            # 新树落盘后才可替换root
+            fdatasync(self.file.fileno())
+        if not root.keys:
+            return
+
+        token = self.task_que.create(is_active=True)
+        org_root = self.root
+        # 同步
+        _ = None
+        for ptr, head, tail in ((1, org_root.ptr, root.ptr), (org_root.ptr, org_root, _), (root.ptr, _, root)):
+            self.task_que.set(token, ptr, head, tail)
+        self.root = root
+        self.do_cum(token, [org_root], {1: pack('Q', root.ptr)})
+
+    @staticmethod
+    def is_closed(filename: str) -> bool:
+        with suppress(OSError), open(filename, 'rb') as file:
+            return file.read(1) == ED
+
+    def bloom_add(self, key):
+        if self.bloom is not None:
+            self.bloom.add(key)
+            if self.bloom.is_stale() and self.bloom_task is None:
+                self.rebuild_bloom()
+        if self.bloom_next is not None:
+            self.bloom_next.add(key)
+
+    def bloom_pop(self):
+        if self.bloom is not None:
+            self.bloom.pops += 1
+            if self.bloom.is_stale() and self.bloom_task is None:
+                self.rebuild_bloom()
+        if self.bloom_next is not None:
+            self.bloom_next.pops += 1
+
+    def rebuild_bloom(self):
+        # 后台遍历所有key，期间的set同时写入新filter
+        async def walk(action):
+            after = None
+            while True:
+                # 多取一项，排除after本身，读Task被中止时重试
+                try:
+                    keys = await self.items(after, None, BLOOM_PAGE + 1, keys_only=True)
+                except SnapshotTooOld:
+                    continue
+                is_last = len(keys) <= BLOOM_PAGE
+                if keys and after is not None and keys[0] == after:
+                    del keys[0]
+                else:
+                    del keys[BLOOM_PAGE:]
+                for key in keys:
+                    action(key)
+                if is_last:
+                    return
+                after = keys[-1]
+
+        async def coro():
+            if self.bloom is None:
+                counter = []
+                await walk(counter.append)
+                num = len(counter)
+            else:
+                num = self.bloom.num - self.bloom.pops
+            self.bloom_next = Bloom(max(2 * num, BLOOM_MIN))
+            await walk(self.bloom_next.add)
+            self.bloom = self.bloom_next
+            self.bloom_next = None
+            self.bloom_task = None
+
+        self.bloom_task = ensure_future(coro())
+
+    def snapshot(self) -> dict:
+        # 各部分统计的快照
+        return {'latency': self.metrics.snapshot(),
+                'get': {'count': self.get_num, 'nodes_per_get': self.get_visits / self.get_num if self.get_num else 0},
+                'io': self.async_file.stats(),
+                'write': self.write_stats(),
+                'node_cache': self.node_cache.stats(),
+                'mvcc': self.task_que.stats(),
+                'allocator': self.allocator_stats(),
+                'memtable': {'entries': len(self.memtable), 'bytes': self.memtable.size, 'flushes': self.flush_num}}
+
+    def close(self):
+        # 重建未完成时保存旧filter
+        if self.bloom_task is not None:
+            self.bloom_task.cancel()
+        if self.bloom is not None:
+            self.bloom.dump(self.bloom_file)
+        super().close()
+
+    async def compact(self, rate=COMPACT_RATE, page_size=COMPACT_PAGE, fill=FILL_FACTOR, min_degree=None):
+        # 按key顺序复制到新文件，期间的写入记入compact_log，追平后替换
+        # min_degree: 新文件的几何，默认不变
+        assert self.compact_log is None
+        min_degree = min_degree or self.min_degree
+        temp = self.filename + '.compact'
+        for name in (temp, temp + '.redo', temp + '.free'):
+            if isfile(name):
+                remove(name)
+        loop = get_event_loop()
+        self.compact_log = {}
+        engine = None
+        try:
+            with open(temp, 'wb') as file:
+                write_head(file, 0, min_degree)
+                loader = BulkLoader(file, HEAD_SIZE, min_degree, self.inline_size, fill, self.codec)
+
+                def add(items: list):
+                    for key, value in items:
+                        loader.add(key, value)
+
+                begin = loop.time()
+                after = None
                 while True:
+                    # 每页使用一个读Task，多取一项排除after本身
+                    # 缓冲不复制，写入树时记入compact_log
                     try:
-                        key, value = load(items)
-                        self.set(key, value)
-                    except EOFError:
+                        page = await self.items(after, None, page_size + 1, buffered=False)
+                    except SnapshotTooOld:
+                        continue
+                    is_last = len(page) <= page_size
+                    if page and after is not None and page[0][0] == after:
+                        del page[0]
+                    else:
+                        del page[page_size:]
+                    await loop.run_in_executor(None, add, page)
+                    if is_last:
                         break
-            remove(temp)
+                    after = page[-1][0]
+                    # 限速，让出I/O给前台请求
+                    if rate:
+                        await sleep(max(begin + (loader.offset + len(loader.buffer)) / rate - loop.time(), 0))
+                root = await loop.run_in_executor(None, loader.finish)
+                file.seek(0)
+                file.write(ED)
+                file.write(pack('Q', root.ptr))
+
+            # 追平复制期间的写入
+            engine = Engine(temp, self.node_cache.max_size, inline_size=self.inline_size, metrics=False,
+                            durability=self.durability)
+            engine.codec = self.codec
+            for _ in range(COMPACT_ROUNDS):
+                log, self.compact_log = self.compact_log, {}
+                if not log:
+                    break
+                engine.write_batch(log)
+                await engine.drain()
+            # 截止后树不再变动，只需等待已有的Task完成
+            self.gate = loop.create_future()
+            await self.drain()
+
+            # 以下同步执行，前台请求只会看到替换前或替换后的状态
+            engine.close()
+            engine = None
+            use_mmap = self.async_file.map_file is not None
+            self.file.close()
+            self.async_file.close()
+            # 替换前崩溃时空闲空间与日志generation不符，遍历重建
+            rename(temp + '.free', self.free_file)
+            rename(temp, self.filename)
+            self.redo.close()
+            # 新文件已由engine.close落盘
+            waiters = self.sync_waiters
+            BasicEngine.__init__(self, self.filename, self.node_cache.max_size, use_mmap, min_degree, self.durability,
+                                 self.task_que.max_size)
+            self.log_memtable()
+            for _, future in waiters:
+                if not future.done():
+                    future.set_result(None)
+            log, self.compact_log = self.compact_log, None
+            if log:
+                self.apply_batch(log)
+            gate, self.gate = self.gate, None
+            gate.set_result(None)
+            # 截止期间的写入在缓冲中，未启用缓冲时立即写入树
+            if not self.memtable_size:
+                self.flush()
+        finally:
+            self.compact_log = None
+            if self.gate is not None:
+                self.gate.set_result(None)
+                self.gate = None
+            if engine is not None:
+                engine.close()
+            for name in (temp, temp + '.free'):
+                if isfile(name):
+                    remove(name)
+
+    def make_value(self, key, value, is_leaf=True):
+        # 叶节点中的小值内联，否则写入ValueNode并返回ptr
+        if is_leaf and self.inline_size:
+            data = dumps(value)
+            if len(data) < self.inline_size:
+                return data
+        val = ValueNode(key, value, codec=self.codec)
+        val_b = bytes(val)
+        val.ptr = self.malloc(val.size)
+        self.write(val.ptr, val_b)
+        return val.ptr
+
+    def spill(self, key, ptr):
+        # 移入内部节点的值不可内联
+        return self.make_value(key, loads(ptr), is_leaf=False) if isinstance(ptr, bytes) else ptr
 
     async def get(self, key):
+        self.get_left -= 1
+        if not self.get_left:
+            self.get_left = SAMPLE_RATE
+            begin = perf_counter()
+            try:
+                return await self.get(key)
+            finally:
+                self.metrics.observe('get', perf_counter() - begin)
+        # filter判定不存在则无需读取
+        self.get_num += 1
+        if self.gate is not None:
+            await shield(self.gate)
+        if self.memtable:
+            entry = self.memtable.get(key)
+            if entry is not None:
+                return None if entry[0] is POP else entry[0]
+        if self.bloom is not None and key not in self.bloom:
+            return
         token = self.task_que.create(is_active=False)
         token.command_num += 1
 
         async def travel(ptr: int):
+            self.get_visits += 1
             init = self.task_que.get(token, ptr, is_active=False)
             if not init:
-                init = await self.async_file.exec(ptr, lambda f: IndexNode(file=f))
+                init = await self.read_node(ptr)
 
             index = bisect(init.keys, key)
             if init.keys[index - 1] == key:
-                ptr = self.task_que.get(token, init.nth_value_ads(index - 1), init.ptr) or init.ptrs_value[index - 1]
-                val = await self.async_file.exec(ptr, lambda f: ValueNode(file=f))
+                ptr = init.ptrs_value[index - 1]
+                if isinstance(ptr, bytes):
+                    return loads(ptr)
+                ptr = self.task_que.get(token, init.nth_value_ads(index - 1), init.ptr) or ptr
+                val = await self.read_value(ptr)
                 assert val.key == key
-                self.a_command_done(token)
                 return val.value
 
             elif not init.is_leaf:
                 ptr = self.task_que.get(token, init.nth_child_ads(index), init.ptr) or init.ptrs_child[index]
                 return await travel(ptr)
-            else:
-                return self.a_command_done(token)
-
-        # root ptrs实时更新
-        index = bisect(self.root.keys, key)
-        if index - 1 >= 0 and self.root.keys[index - 1] == key:
-            ptr = self.root.ptrs_value[index - 1]
-            val = await self.async_file.exec(ptr, lambda f: ValueNode(file=f))
-            assert val.key == key
+
+        # 中止时读Task同样需要完成
+        try:
+            # root ptrs实时更新
+            index = bisect(self.root.keys, key)
+            if index - 1 >= 0 and self.root.keys[index - 1] == key:
+                ptr = self.root.ptrs_value[index - 1]
+                if isinstance(ptr, bytes):
+                    return loads(ptr)
+                val = await self.read_value(ptr)
+                assert val.key == key
+                return val.value
+
+            elif not self.root.is_leaf:
+                return await travel(self.root.ptrs_child[index])
+        finally:
             self.a_command_done(token)
-            return val.value
 
-        elif not self.root.is_leaf:
-            return await travel(self.root.ptrs_child[index])
-        else:
-            return self.a_command_done(token)
+    async def get_many(self, keys) -> list:
+        # 一次遍历查询多个key，结果与keys顺序一致，不存在为None
+        keys = list(keys)
+        if self.gate is not None:
+            await shield(self.gate)
+        buffered = {key: self.memtable.get(key)[0] for key in keys if key in self.memtable} if self.memtable else {}
+        wanted = sorted(set(key for key in keys
+                            if key not in buffered and (self.bloom is None or key in self.bloom)))
+        token = self.task_que.create(is_active=False)
+        token.command_num += 1
+        # found: {..., key: ptr OR 内联值}
+        found = {}
+
+        def search(init: IndexNode, keys: list, is_root=False) -> list:
+            # 记录位于init的key，其余按子节点分组: [..., (ptr, keys)]
+            groups = []
+            i = 0
+            while i < len(keys):
+                key = keys[i]
+                index = bisect(init.keys, key)
+                if index and init.keys[index - 1] == key:
+                    ptr = init.ptrs_value[index - 1]
+                    # root ptrs实时更新
+                    if not is_root and isinstance(ptr, int):
+                        ptr = self.task_que.get(token, init.nth_value_ads(index - 1), init.ptr) or ptr
+                    found[key] = ptr
+                    i += 1
+                elif init.is_leaf:
+                    i += 1
+                else:
+                    # 小于init.keys[index]的key同属一个子节点
+                    j = bisect_left(keys, init.keys[index], i) if index < len(init.keys) else len(keys)
+                    ptr = init.ptrs_child[index]
+                    if not is_root:
+                        ptr = self.task_que.get(token, init.nth_child_ads(index), init.ptr) or ptr
+                    groups.append((ptr, keys[i:j]))
+                    i = j
+            return groups
+
+        async def wait_all(coros):
+            # 各分支均结束后再抛出，读Task完成时不留进行中的读取
+            for result in await gather(*coros, return_exceptions=True):
+                if isinstance(result, BaseException):
+                    raise result
+
+        async def travel(ptr: int, keys: list):
+            init = self.task_que.get(token, ptr, is_active=False)
+            if not init:
+                init = await self.read_node(ptr)
+            await wait_all(travel(*group) for group in search(init, keys))
+
+        try:
+            await wait_all(travel(*group) for group in search(self.root, wanted, is_root=True))
+            # 值按偏移批量读取
+            ptrs = [ptr for ptr in found.values() if isinstance(ptr, int)]
+            vals = dict(zip(ptrs, await self.read_values(ptrs)))
+        finally:
+            self.a_command_done(token)
+
+        for key, ptr in found.items():
+            if isinstance(ptr, bytes):
+                found[key] = loads(ptr)
+            else:
+                val = vals[ptr]
+                assert val.key == key
+                found[key] = val.value
+        found.update(buffered)
+        return [None if found.get(key) is POP else found.get(key) for key in keys]
+
+    def peek(self, key):
+        # 同步查找最新的值，读取方式同do_pop
+        token = Task(self.task_que.next_id, is_active=True)
+        init = self.root
+        while True:
+            index = bisect(init.keys, key)
+            if index and init.keys[index - 1] == key:
+                ptr = init.ptrs_value[index - 1]
+                if isinstance(ptr, bytes):
+                    return loads(ptr)
+                self.file.seek(ptr)
+                return ValueNode(file=self.file, codec=self.codec).value
+            elif init.is_leaf:
+                return
+            init = self.task_que.get(token, init.ptrs_child[index]) or self.fetch_node(init.ptrs_child[index])
+            self.time_travel(token, init)
 
     def set(self, key, value):
+        self.set_left -= 1
+        if not self.set_left:
+            self.set_left = SAMPLE_RATE
+            begin = perf_counter()
+            try:
+                return self.set(key, value)
+            finally:
+                self.metrics.observe('set', perf_counter() - begin)
+        if self.memtable_size or self.gate is not None:
+            return self.buffer({key: value})
         token = self.task_que.create(is_active=True)
         free_nodes = []
         # command_map: {..., ptr: data OR (data, depend)}
         command_map = {}
+        self.do_set(token, free_nodes, command_map, key, value)
+        self.do_cum(token, free_nodes, command_map)
+
+    def pop(self, key):
+        self.pop_left -= 1
+        if not self.pop_left:
+            self.pop_left = SAMPLE_RATE
+            begin = perf_counter()
+            try:
+                return self.pop(key)
+            finally:
+                self.metrics.observe('pop', perf_counter() - begin)
+        if self.gate is not None:
+            # 删除作为标记进入缓冲，替换后写入新文件
+            entry = self.memtable.get(key)
+            value = self.peek(key) if entry is None else entry[0]
+            self.buffer({key: POP})
+            return None if value is POP else value
+        # 缓冲中的值较新，删除记录随本Task写入日志
+        entry = self.memtable.discard(key) if key in self.memtable else None
+        if entry is not None:
+            self.redo_writes.append((MEM_PTR, dumps([(key,)])))
+        token = self.task_que.create(is_active=True)
+        free_nodes = []
+        command_map = {}
+        result = self.do_pop(token, free_nodes, command_map, key)
+        self.do_cum(token, free_nodes, command_map)
+        if entry is None:
+            return result
+        return None if entry[0] is POP else entry[0]
+
+    def write_batch(self, items: dict):
+        # items: {..., key: value OR POP}
+        if self.memtable_size or self.gate is not None:
+            return self.buffer(items)
+        self.apply_batch(items)
+
+    def buffer(self, items: dict):
+        # 写入缓冲并记入日志，其中的删除直接作用于树，与日志记录同属一个Task
+        # 整理截止期间删除作为标记留在缓冲
+        ops = [(key,) if value is POP else (key, value) for key, value in items.items()]
+        if not ops:
+            return
+        data = dumps(ops)
+        # 各项按记录的平均大小计量
+        size = len(data) // len(ops)
+        pops = {}
+        for key, value in items.items():
+            if value is POP and self.gate is not None:
+                self.memtable.put(key, POP, size)
+            elif value is POP:
+                self.memtable.discard(key)
+                pops[key] = POP
+            else:
+                self.memtable.put(key, value, size)
+        if pops:
+            self.redo_writes.append((MEM_PTR, data))
+            self.apply_batch(pops)
+        else:
+            self.log([(MEM_PTR, data)])
+        # 日志过长时写入树，写入完成后才能截断
+        if self.memtable.size >= self.memtable_size or self.redo.size >= REDO_SIZE and not self.on_write:
+            self.flush()
+
+    def flush(self):
+        # 缓冲按key顺序作为一个Task写入树，同一记录中的清空标记使重做时不再重复
+        if self.memtable and self.gate is None:
+            self.flush_num += 1
+            self.redo_writes.append((MEM_PTR, CLEAR))
+            self.apply_batch(self.memtable.clear())
+
+    def apply_batch(self, items: dict):
+        # 同一Task内按key顺序执行
+        token = self.task_que.create(is_active=True)
+        free_nodes = []
+        command_map = {}
+        for key in sorted(items):
+            value = items[key]
+            if value is POP:
+                self.do_pop(token, free_nodes, command_map, key)
+            else:
+                self.do_set(token, free_nodes, command_map, key, value)
+            # root ptrs实时更新
+            self.time_travel(token, self.root)
+        self.do_cum(token, free_nodes, command_map)
+
+    def do_set(self, token: Task, free_nodes: list, command_map: dict, key, value):
+        if self.compact_log is not None:
+            self.compact_log[key] = value
 
         def replace(address: int, ptr: int, depend: int):
             self.file.seek(ptr)
-            org_val = ValueNode(file=self.file)
+            org_val = ValueNode(file=self.file, codec=self.codec)
             if org_val.value != value:
                 # 写入新Val
-                val = ValueNode(key, value)
-                self.file.seek(self.async_file.size)
-                val.dump(self.file)
+                val = ValueNode(key, value, codec=self.codec)
+                val_b = bytes(val)
+                val.ptr = self.async_file.size
+                self.write(val.ptr, val_b)
                 self.async_file.size += val.size
                 # 状态设为0
-                self.file.seek(org_val.ptr)
-                self.file.write(pack('B', 0))
+                self.write(org_val.ptr, pack('B', 0))
 
                 # 释放
-                token.free_param = lambda: self.free(org_val.ptr, org_val.size)
+                token.free_params.append((org_val.ptr, org_val.size))
                 # 同步
                 self.task_que.set(token, address, org_val.ptr, val.ptr)
                 # 命令
-                self.ensure_write(token, address, pack('Q', val.ptr), depend)
-            self.do_cum(token, free_nodes, command_map)
+                command_map[address] = (pack('Q', val.ptr), depend)
+
+        def update(address: int, leaf: IndexNode, index: int, depend: int):
+            # 内联值变动需重写叶节点
+            ptr = leaf.ptrs_value[index]
+            data = dumps(value) if self.inline_size else None
+            if isinstance(ptr, bytes):
+                if ptr == data:
+                    return
+            elif data is None or len(data) >= self.inline_size:
+                return replace(leaf.nth_value_ads(index), ptr, leaf.ptr)
+            else:
+                self.file.seek(ptr)
+                org_val = ValueNode(file=self.file, codec=self.codec)
+                if org_val.value == value:
+                    return
+                # 新叶节点在本Task内同步写入，随即标记
+                self.write(org_val.ptr, pack('B', 0))
+                token.free_params.append((org_val.ptr, org_val.size))
+
+            org_leaf = leaf.clone()
+            leaf.ptrs_value[index] = self.make_value(key, value)
+            leaf_b = bytes(leaf)
+            leaf.ptr = self.malloc(leaf.size)
+            # 更新完毕
+
+            # 释放
+            free_nodes.append(org_leaf)
+            # 同步
+            _ = None
+            for ptr, head, tail in ((address, org_leaf.ptr, leaf.ptr),
+                                    (org_leaf.ptr, org_leaf, _), (leaf.ptr, _, leaf)):
+                self.task_que.set(token, ptr, head, tail)
+            # 命令
+            command_map.update({address: (pack('Q', leaf.ptr), depend), leaf.ptr: leaf_b})
 
         def split(address: int, par: IndexNode, child_index: int, child: IndexNode, depend: int):
             org_par = par.clone()
@@ -248,8 +1262,9 @@ class Engine(BasicEngine):
                 del child.ptrs_child[mi:]
 
             # parent需一个值
-            par.keys.insert(child_index, child.keys.pop())
-            par.ptrs_value.insert(child_index, child.ptrs_value.pop())
+            mid_key = child.keys.pop()
+            par.keys.insert(child_index, mid_key)
+            par.ptrs_value.insert(child_index, self.spill(mid_key, child.ptrs_value.pop()))
 
             # 分配空间
             child_b = bytes(child)
@@ -279,7 +1294,7 @@ class Engine(BasicEngine):
         address = 1
         depend = 0
         # root准满载
-        if len(cursor.keys) == 2 * MIN_DEGREE - 1:
+        if len(cursor.keys) == 2 * self.min_degree - 1:
             # 新建root
             root = IndexNode(is_leaf=False)
             root.ptrs_child.append(self.root.ptr)
@@ -294,17 +1309,16 @@ class Engine(BasicEngine):
                 return replace(cursor.nth_value_ads(index - 1), cursor.ptrs_value[index - 1], cursor.ptr)
 
             ptr = cursor.ptrs_child[index]
-            child = self.task_que.get(token, ptr)
-            if not child:
-                self.file.seek(ptr)
-                child = IndexNode(file=self.file)
+            child = self.task_que.get(token, ptr) or self.fetch_node(ptr)
             self.time_travel(token, child)
 
             i = bisect_left(child.keys, key)
             if i < len(child.keys) and child.keys[i] == key:
+                if child.is_leaf:
+                    return update(cursor.nth_child_ads(index), child, i, cursor.ptr)
                 return replace(child.nth_value_ads(i), child.ptrs_value[i], child.ptr)
 
-            if len(child.keys) == 2 * MIN_DEGREE - 1:
+            if len(child.keys) == 2 * self.min_degree - 1:
                 split(address, cursor, index, child, depend)
                 if cursor.keys[index] < key:
                     # 路径转移至sibling，且必存在于task_que
@@ -320,17 +1334,12 @@ class Engine(BasicEngine):
         index = bisect(cursor.keys, key)
         # cursor可能是root且可能为空
         if cursor is self.root and cursor.keys and cursor.keys[index - 1] == key:
-            return replace(cursor.nth_value_ads(index - 1), cursor.ptrs_value[index - 1], cursor.ptr)
+            return update(address, cursor, index - 1, depend)
 
         org_cursor = cursor.clone()
-        val = ValueNode(key, value)
-        val_b = bytes(val)
-        val.ptr = self.malloc(val.size)
-        self.file.seek(val.ptr)
-        self.file.write(val_b)
-
-        cursor.keys.insert(index, val.key)
-        cursor.ptrs_value.insert(index, val.ptr)
+        cursor.keys.insert(index, key)
+        cursor.ptrs_value.insert(index, self.make_value(key, value))
+        self.bloom_add(key)
         cursor_b = bytes(cursor)
         cursor.ptr = self.malloc(cursor.size)
         # 更新完毕
@@ -344,23 +1353,17 @@ class Engine(BasicEngine):
             self.task_que.set(token, ptr, head, tail)
         # 命令
         command_map.update({address: (pack('Q', cursor.ptr), depend), cursor.ptr: cursor_b})
-        self.do_cum(token, free_nodes, command_map)
 
-    def pop(self, key):
-        token = self.task_que.create(is_active=True)
-        free_nodes = []
-        command_map = {}
+    def do_pop(self, token: Task, free_nodes: list, command_map: dict, key):
+        if self.compact_log is not None:
+            self.compact_log[key] = POP
 
         def indicate(val: ValueNode):
-            self.file.seek(val.ptr)
-            self.file.write(pack('B', 0))
-            token.free_param = lambda: self.free(val.ptr, val.size)
+            self.write(val.ptr, pack('B', 0))
+            token.free_params.append((val.ptr, val.size))
 
         def fetch(ptr: int) -> IndexNode:
-            result = self.task_que.get(token, ptr)
-            if not result:
-                self.file.seek(ptr)
-                result = IndexNode(file=self.file)
+            result = self.task_que.get(token, ptr) or self.fetch_node(ptr)
             self.time_travel(token, result)
             return result
 
@@ -377,7 +1380,7 @@ class Engine(BasicEngine):
             val_ptr = par.ptrs_value[val_index]
 
             par.keys[val_index] = last_val_key
-            par.ptrs_value[val_index] = last_val_ptr
+            par.ptrs_value[val_index] = self.spill(last_val_key, last_val_ptr)
             right_child.keys.insert(0, val_key)
             right_child.ptrs_value.insert(0, val_ptr)
 
@@ -423,7 +1426,7 @@ class Engine(BasicEngine):
             val_ptr = par.ptrs_value[val_index]
 
             par.keys[val_index] = first_val_key
-            par.ptrs_value[val_index] = first_val_ptr
+            par.ptrs_value[val_index] = self.spill(first_val_key, first_val_ptr)
             left_child.keys.append(val_key)
             left_child.ptrs_value.append(val_ptr)
 
@@ -533,16 +1536,24 @@ class Engine(BasicEngine):
 
             def key_in_leaf():
                 org_init = init.clone()
-                self.file.seek(init.ptrs_value[index])
-                val = ValueNode(file=self.file)
+                ptr = init.ptrs_value[index]
+                if isinstance(ptr, bytes):
+                    val = None
+                    value = loads(ptr)
+                else:
+                    self.file.seek(ptr)
+                    val = ValueNode(file=self.file, codec=self.codec)
+                    value = val.value
                 # 内存
                 del init.keys[index]
                 del init.ptrs_value[index]
+                self.bloom_pop()
                 # 空间
                 init_b = bytes(init)
                 init.ptr = self.malloc(init.size)
                 # 释放
-                indicate(val)
+                if val:
+                    indicate(val)
                 free_nodes.append(org_init)
                 # 同步
                 _ = None
@@ -551,7 +1562,7 @@ class Engine(BasicEngine):
                     self.task_que.set(token, ptr, head, tail)
                 # 命令
                 command_map.update({address: (pack('Q', init.ptr), depend), init.ptr: init_b})
-                return val.value
+                return value
 
             def root_is_empty(successor: IndexNode):
                 free_nodes.append(self.root)
@@ -575,11 +1586,11 @@ class Engine(BasicEngine):
                     right_child = fetch(right_ptr)
 
                     # 左子节点 >= t
-                    if len(left_child.keys) >= MIN_DEGREE:
+                    if len(left_child.keys) >= self.min_degree:
                         rotate_left(address, init, index, left_child, right_child, depend)
                         return travel(init.nth_child_ads(index + 1), right_child, key, init.ptr)
                     # 右子节点 >= t
-                    elif len(right_child.keys) >= MIN_DEGREE:
+                    elif len(right_child.keys) >= self.min_degree:
                         rotate_right(address, init, index, left_child, right_child, depend)
                         return travel(init.nth_child_ads(index), left_child, key, init.ptr)
                     # 左右子节点均 < t
@@ -595,14 +1606,14 @@ class Engine(BasicEngine):
                 cursor = fetch(ptr)
 
                 # 目标 < t
-                if len(cursor.keys) < MIN_DEGREE:
+                if len(cursor.keys) < self.min_degree:
                     left_sibling = right_sibling = None
 
                     if index - 1 >= 0:
                         left_ptr = init.ptrs_child[index - 1]
                         left_sibling = fetch(left_ptr)
                         # 左sibling >= t
-                        if len(left_sibling.keys) >= MIN_DEGREE:
+                        if len(left_sibling.keys) >= self.min_degree:
                             rotate_left(address, init, index - 1, left_sibling, cursor, depend)
                             return travel(init.nth_child_ads(index), cursor, key, init.ptr)
 
@@ -610,7 +1621,7 @@ class Engine(BasicEngine):
                         right_ptr = init.ptrs_child[index + 1]
                         right_sibling = fetch(right_ptr)
                         # 右sibling >= t
-                        if len(right_sibling.keys) >= MIN_DEGREE:
+                        if len(right_sibling.keys) >= self.min_degree:
                             rotate_right(address, init, index, cursor, right_sibling, depend)
                             return travel(init.nth_child_ads(index), cursor, key, init.ptr)
 
@@ -624,26 +1635,51 @@ class Engine(BasicEngine):
                         root_is_empty(cursor)
                 return travel(init.nth_child_ads(index), cursor, key, init.ptr)
 
-        travel(1, self.root, key, 0)
-        self.do_cum(token, free_nodes, command_map)
+        return travel(1, self.root, key, 0)
 
-    async def items(self, item_from=None, item_to=None, max_len=0, reverse=False):
+    async def items(self, item_from=None, item_to=None, max_len=0, reverse=False, keys_only=False, buffered=True):
+        # buffered: 是否合并写缓冲
         assert item_from <= item_to if item_from and item_to else True
+        if self.gate is not None:
+            await shield(self.gate)
+        # 缓冲与读Task同时取得，之后的写入不可见
+        buffered = self.memtable.range(item_from, item_to, reverse) if buffered and self.memtable else None
+        # 缓冲中的删除标记可能抵消树中的项，多取相应项数
+        limit = max_len and max_len + sum(value is POP for _, value in buffered or ())
         token = self.task_que.create(is_active=False)
         token.command_num += 1
         result = []
 
         async def travel(init: IndexNode):
             async def get_item(index: int):
+                if keys_only:
+                    return init.keys[index]
                 ptr = init.ptrs_value[index]
-                val = await self.async_file.exec(ptr, lambda f: ValueNode(file=f))
+                val = await self.read_value(ptr)
                 return val.key, val.value
 
+            async def get_items(indexes: range):
+                if keys_only:
+                    return result.extend(init.keys[i] for i in indexes)
+                # 内联值的key需在await前取出
+                entries = []
+                for i in indexes:
+                    ptr = init.ptrs_value[i]
+                    entries.append((init.keys[i], ptr) if isinstance(ptr, bytes) else (None, ptr))
+                vals = iter(await self.read_values([ptr for _, ptr in entries if isinstance(ptr, int)]))
+                for key, ptr in entries:
+                    if isinstance(ptr, bytes):
+                        result.append((key, loads(ptr)))
+                    else:
+                        val = next(vals)
+                        result.append((val.key, val.value))
+
             async def get_child(index: int) -> IndexNode:
                 ptr = init.ptrs_child[index]
-                child = self.task_que.get(token, ptr, is_active=False)
+                # 版本及缓存对象共享，需复制后修改
+                child = self.task_que.get(token, ptr)
                 if not child:
-                    child = await self.async_file.exec(ptr, lambda f: IndexNode(file=f))
+                    child = (await self.read_node(ptr)).clone()
                 self.time_travel(token, child)
                 return child
 
@@ -652,25 +1688,43 @@ class Engine(BasicEngine):
             lo = 0 if item_from is None else bisect_left(init.keys, item_from)
             hi = len(init.keys) if item_to is None else bisect(init.keys, item_to)
 
-            extend = not init.is_leaf and (item_from is None or lo == len(init.keys) or init.keys[lo] > item_from)
+            # 叶节点的值一并读取
+            if init.is_leaf:
+                indexes = range(lo, hi) if not reverse else range(hi - 1, lo - 1, -1)
+                if limit:
+                    indexes = indexes[:max(limit - len(result), 0)]
+                return await get_items(indexes)
+
+            extend = item_from is None or lo == len(init.keys) or init.keys[lo] > item_from
             if not reverse and extend:
                 await travel(await get_child(lo))
 
             for i in range(lo, hi) if not reverse else reversed(range(lo, hi)):
-                if reverse and not init.is_leaf:
+                if reverse:
                     await travel(await get_child(i + 1))
 
-                if max_len and len(result) >= max_len:
+                if limit and len(result) >= limit:
                     return
                 item = await get_item(i)
                 result.append(item)
 
-                if not reverse and not init.is_leaf:
+                if not reverse:
                     await travel(await get_child(i + 1))
 
             if reverse and extend:
                 await travel(await get_child(lo))
 
-        await travel(self.root)
-        self.a_command_done(token)
+        try:
+            # root实时更新，遍历期间需使用与读Task同时的副本
+            await travel(self.root.clone())
+        finally:
+            self.a_command_done(token)
+        if buffered:
+            # 缓冲中的值覆盖树中的值，合并后取前max_len项
+            merged = dict.fromkeys(result) if keys_only else dict(result)
+            merged.update(buffered)
+            keys = sorted((key for key, value in merged.items() if value is not POP), reverse=reverse)
+            if max_len:
+                del keys[max_len:]
+            result = keys if keys_only else [(key, merged[key]) for key in keys]
         return result
@@ -0,0 +1,78 @@
+from bisect import bisect, bisect_left, insort
+from pickle import dumps, loads
+
+# write_batch中表示删除，缓冲中为待写入树的删除
+POP = object()
+
+
+class MemTable:
+    # 有序的内存写缓冲，按key顺序批量写入树
+    def __init__(self):
+        # 有序的key
+        self.keys = []
+        # data: {..., key: (value OR POP, size)}，size为pickle后的字节数
+        self.data = {}
+        self.size = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key) -> bool:
+        return key in self.data
+
+    def get(self, key):
+        # 返回(value, size)，不存在返回None
+        return self.data.get(key)
+
+    def put(self, key, value, size: int):
+        entry = self.data.get(key)
+        if entry is None:
+            insort(self.keys, key)
+        else:
+            self.size -= entry[1]
+        self.data[key] = (value, size)
+        self.size += size
+
+    def discard(self, key):
+        # 返回(value, size)，不存在返回None
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            del self.keys[bisect_left(self.keys, key)]
+            self.size -= entry[1]
+        return entry
+
+    def range(self, item_from=None, item_to=None, reverse=False) -> list:
+        # item_from <= key <= item_to的[..., (key, value)]
+        lo = 0 if item_from is None else bisect_left(self.keys, item_from)
+        hi = len(self.keys) if item_to is None else bisect(self.keys, item_to)
+        keys = self.keys[lo:hi]
+        if reverse:
+            keys.reverse()
+        return [(key, self.data[key][0]) for key in keys]
+
+    def clear(self) -> dict:
+        # 清空并返回{..., key: value}
+        items = {key: self.data[key][0] for key in self.keys}
+        self.keys = []
+        self.data = {}
+        self.size = 0
+        return items
+
+    def dumps(self) -> bytes:
+        # 日志记录: [..., (key, value)]，移出缓冲为(key,)，待写入的删除为(key, None, None)，清空为None
+        return dumps([(key, None, None) if self.data[key][0] is POP else (key, self.data[key][0])
+                      for key in self.keys])
+
+    def load(self, data: bytes):
+        # 按顺序重做日志记录
+        ops = loads(data)
+        if ops is None:
+            self.clear()
+            return
+        for op in ops:
+            if len(op) == 1:
+                self.discard(op[0])
+            elif len(op) == 3:
+                self.put(op[0], POP, len(dumps(op)))
+            else:
+                self.put(op[0], op[1], len(dumps(op)))
@@ -0,0 +1,77 @@
+from collections.abc import Callable
+from functools import wraps
+from inspect import iscoroutinefunction
+from time import perf_counter
+
+# 第i桶为[2 ** (i - 1), 2 ** i)微秒
+BUCKET_NUM = 32
+# get/set/pop每SAMPLE_RATE次调用计时一次
+SAMPLE_RATE = 64
+
+
+class Histogram:
+    # 按2的幂分桶的耗时统计
+    def __init__(self):
+        self.buckets = [0] * BUCKET_NUM
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.buckets[min(int(seconds * 1000000).bit_length(), BUCKET_NUM - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        # 所在桶的上界，不超过最大值
+        rank = q * self.count
+        num = 0
+        for i, n in enumerate(self.buckets):
+            num += n
+            if n and num >= rank:
+                return min((1 << i) / 1000000, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99), 'max': self.max}
+
+
+class Metrics:
+    # 各操作抽样的耗时直方图，hooks: [..., callback(name, seconds)]
+    def __init__(self):
+        self.histograms = {}
+        self.hooks = []
+
+    def observe(self, name: str, seconds: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+        for hook in self.hooks:
+            hook(name, seconds)
+
+    def timed(self, name: str, func: Callable) -> Callable:
+        # 包装func，每次调用计时，协程计入await的全部时间
+        observe = self.observe
+
+        if iscoroutinefunction(func):
+            async def wrapper(*args, **kwargs):
+                begin = perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    observe(name, perf_counter() - begin)
+        else:
+            def wrapper(*args, **kwargs):
+                begin = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    observe(name, perf_counter() - begin)
+        return wraps(func)(wrapper)
+
+    def snapshot(self) -> dict:
+        return {name: histogram.snapshot() for name, histogram in self.histograms.items()}
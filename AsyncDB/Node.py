@@ -1,6 +1,155 @@
+import bz2
+import lzma
+import zlib
+from collections.abc import Sequence
 from io import FileIO
-from pickle import dumps, load
-from struct import pack, unpack
+from os.path import commonprefix
+from pickle import dumps, load, loads
+from struct import pack, unpack, unpack_from, Struct
+from sys import byteorder
+from zlib import crc32
+
+# 首字节区别于pickle的PROTO(0x80)
+NODE_VERSION = 0x81
+# version, flags, key数量, body长度
+NODE_HEAD = Struct('<BBHI')
+PICKLE_PROTO = 0x80
+# 叶节点含内联值
+INLINE = 0x20
+# 状态, key数据长度, 值偏移宽度, crc
+# 状态同ValueNode: 0已被取代 1正常，位于节点头之后，repair时跳过已取代的叶节点
+INLINE_HEAD = Struct('<BIBI')
+
+# indicator, flags, 数据长度
+VALUE_HEAD = Struct('<BBI')
+# 值的压缩编码，记录于VALUE_HEAD的flags
+RAW, ZLIB, LZMA, BZ2, ZDICT = range(5)
+CODECS = {'zlib': ZLIB, 'lzma': LZMA, 'bz2': BZ2, 'zdict': ZDICT}
+# ZDICT数据前记录字典的crc
+ZDICT_HEAD = Struct('<I')
+# pickle后不小于此长度的值才压缩
+COMPRESS_SIZE = 512
+# zlib窗口，更早的字典内容不会被引用
+DICT_SIZE = 32 * 1024
+
+# key编码
+PICKLE, INT, STR, BYTES = range(4)
+# 各key的编码共享前缀，只存一次: 前缀长度 + 前缀 + 各后缀
+# 节点flags中左移1位后为0x40，与INLINE错开
+PREFIX = 0x20
+PREFIX_HEAD = Struct('<I')
+KEY_FLAGS = 0xf | PREFIX
+# 整数及偏移宽度: 1 << width 字节
+INT_FORMATS = 'bhiq'
+OFFSET_FORMATS = 'BHIQ'
+
+
+def int_width(lo: int, hi: int) -> int:
+    for width in range(4):
+        bound = 1 << (8 << width) - 1
+        if -bound <= lo and hi < bound:
+            return width
+
+
+def encode_keys(keys) -> (int, bytes):
+    # 同类key使用紧凑编码，其余pickle
+    # flags: codec | width << 2
+    types = set(map(type, keys))
+    if not types or types == {int}:
+        width = int_width(min(keys), max(keys)) if keys else 0
+        if width is not None:
+            return INT | width << 2, pack('<%d%s' % (len(keys), INT_FORMATS[width]), *keys)
+
+    if types == {str}:
+        try:
+            items = [key.encode() for key in keys]
+            codec = STR
+        except UnicodeEncodeError:
+            items = [dumps(key) for key in keys]
+            codec = PICKLE
+    elif types == {bytes}:
+        items = keys
+        codec = BYTES
+    else:
+        items = [dumps(key) for key in keys]
+        codec = PICKLE
+
+    prefix = commonprefix(items)
+    if len(prefix) > PREFIX_HEAD.size:
+        size = len(prefix)
+        width, body = pack_items([item[size:] for item in items])
+        return codec | width << 2 | PREFIX, PREFIX_HEAD.pack(size) + prefix + body
+    width, body = pack_items(items)
+    return codec | width << 2, body
+
+
+def pack_items(items: list) -> (int, bytes):
+    # 各项的结束偏移 + 数据
+    offsets = []
+    end = 0
+    for item in items:
+        end += len(item)
+        offsets.append(end)
+    # 无符号偏移
+    width = int_width(0, end >> 1)
+    return width, pack('<%d%s' % (len(offsets), OFFSET_FORMATS[width]), *offsets) + b''.join(items)
+
+
+def unpack_items(width: int, count: int, body: memoryview) -> list:
+    offsets = unpack_from('<%d%s' % (count, OFFSET_FORMATS[width]), body)
+    data = body[count << width:]
+    result = []
+    begin = 0
+    for end in offsets:
+        result.append(bytes(data[begin:end]))
+        begin = end
+    return result
+
+
+class KeyView(Sequence):
+    # 直接在序列化数据上bisect，不构建key列表
+    def __init__(self, flags: int, count: int, body: memoryview):
+        self.codec = flags & 3
+        self.count = count
+        width = flags >> 2 & 3
+        self.prefix = b''
+        if flags & PREFIX:
+            size = PREFIX_HEAD.unpack_from(body)[0]
+            self.prefix = bytes(body[PREFIX_HEAD.size:PREFIX_HEAD.size + size])
+            body = body[PREFIX_HEAD.size + size:]
+        self.offsets = unpack_from('<%d%s' % (count, OFFSET_FORMATS[width]), body)
+        self.data = body[count << width:]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('key index out of range')
+
+        item = self.data[self.offsets[index - 1] if index else 0:self.offsets[index]]
+        if self.prefix:
+            item = self.prefix + item
+        if self.codec == STR:
+            return str(item, 'utf-8')
+        elif self.codec == BYTES:
+            return bytes(item)
+        else:
+            return loads(item)
+
+
+def decode_keys(flags: int, count: int, body: memoryview):
+    if flags & 3 == INT:
+        width = flags >> 2 & 3
+        # 小端机器直接映射为整数数组
+        if byteorder == 'little':
+            return body.cast(INT_FORMATS[width])
+        return list(unpack_from('<%d%s' % (count, INT_FORMATS[width]), body))
+    return KeyView(flags, count, body)
 
 
 class IndexNode:
@@ -18,13 +167,73 @@ class IndexNode:
             self.load(file)
 
     def __bytes__(self):
-        result = dumps([self.is_leaf, self.keys]) + b''.join(pack('Q', ptr) for ptr in self.ptrs_value)
+        # flags: is_leaf | key编码 << 1 | INLINE，key编码含PREFIX
+        flags, body = encode_keys(self.keys)
+        flags = self.is_leaf | flags << 1
+        ptrs_value = self.ptrs_value
+        if self.has_inline():
+            # body: INLINE_HEAD + keys + 值，内联项的ptr为0
+            width, values = pack_items([ptr if isinstance(ptr, bytes) else b'' for ptr in ptrs_value])
+            data = body + values
+            body = INLINE_HEAD.pack(1, len(body), width, crc32(data)) + data
+            flags |= INLINE
+            ptrs_value = [0 if isinstance(ptr, bytes) else ptr for ptr in ptrs_value]
+
+        result = NODE_HEAD.pack(NODE_VERSION, flags, len(self.keys), len(body)) + body
+        result += pack('%dQ' % len(ptrs_value), *ptrs_value)
         if not self.is_leaf:
-            result += b''.join(pack('Q', ptr) for ptr in self.ptrs_child)
+            result += pack('%dQ' % len(self.ptrs_child), *self.ptrs_child)
         self.size = len(result)
         return result
 
+    @staticmethod
+    def size_of(head: bytes) -> int:
+        # 由头部得到节点长度，旧格式为0
+        if head[0] == PICKLE_PROTO:
+            return 0
+        _, flags, count, body_len = NODE_HEAD.unpack_from(head)
+        ptr_num = count if flags & 1 else 2 * count + 1
+        return NODE_HEAD.size + body_len + 8 * ptr_num
+
     def load(self, file: FileIO):
+        ptr = file.tell()
+        head = file.read(NODE_HEAD.size)
+        if head[0] == PICKLE_PROTO:
+            file.seek(ptr)
+            return self.load_pickle(file)
+        self.loads(ptr, head + file.read(IndexNode.size_of(head) - NODE_HEAD.size))
+
+    def loads(self, ptr: int, data: bytes):
+        # data需为独立副本，keys直接引用
+        self.ptr = ptr
+        version, flags, count, body_len = NODE_HEAD.unpack_from(data)
+        assert version == NODE_VERSION
+        self.is_leaf = bool(flags & 1)
+
+        ptr_num = count if self.is_leaf else 2 * count + 1
+        data = memoryview(data)
+        begin = NODE_HEAD.size
+        end = NODE_HEAD.size + body_len
+        ptrs = unpack_from('Q' * ptr_num, data, end)
+
+        if flags & INLINE:
+            _, key_len, width, crc = INLINE_HEAD.unpack_from(data, begin)
+            begin += INLINE_HEAD.size
+            assert crc32(data[begin:end]) == crc
+            values = unpack_items(width, count, data[begin + key_len:end])
+            self.keys = decode_keys(flags >> 1 & KEY_FLAGS, count, data[begin:begin + key_len])
+            self.ptrs_value = [value or ptr for ptr, value in zip(ptrs, values)]
+        elif self.is_leaf:
+            self.keys = decode_keys(flags >> 1 & KEY_FLAGS, count, data[begin:end])
+            self.ptrs_value = list(ptrs)
+        else:
+            self.keys = decode_keys(flags >> 1 & KEY_FLAGS, count, data[begin:end])
+            self.ptrs_value = list(ptrs[:count])
+            self.ptrs_child = list(ptrs[count:])
+        self.size = NODE_HEAD.size + body_len + 8 * ptr_num
+
+    def load_pickle(self, file: FileIO):
+        # 旧格式
         self.ptr = file.tell()
         self.is_leaf, self.keys = load(file)
 
@@ -49,12 +258,17 @@ class IndexNode:
         result.ptr = self.ptr
         result.size = self.size
 
-        result.keys = self.keys[:]
+        # 读取所得的keys只读
+        result.keys = list(self.keys)
         result.ptrs_value = self.ptrs_value[:]
         if not result.is_leaf:
             result.ptrs_child = self.ptrs_child[:]
         return result
 
+    def has_inline(self) -> bool:
+        # 内联值为bytes，只存在于叶节点
+        return self.is_leaf and not all(isinstance(ptr, int) for ptr in self.ptrs_value)
+
     def nth_child_ads(self, n: int) -> int:
         assert self.ptr > 0 and self.size > 0
         return self.ptr + self.size - (len(self.keys) + 1 - n) * 8
@@ -64,10 +278,69 @@ class IndexNode:
         return tail - (len(self.keys) - n) * 8
 
 
+def train_dictionary(samples, size=DICT_SIZE) -> bytes:
+    # 由样本值拼接共享字典，zlib优先匹配靠后的内容，出现越多的片段越靠后
+    counts = {}
+    for value in samples:
+        data = dumps(value)
+        counts[data] = counts.get(data, 0) + 1
+    result = b''.join(sorted(counts, key=counts.get))
+    return result[-size:]
+
+
+class ValueCodec:
+    # 值的压缩设置，zdict以最后一个字典压缩，各字典均可用于读取
+    def __init__(self, name=None, threshold=COMPRESS_SIZE, dictionaries=()):
+        self.codec = CODECS[name] if name else RAW
+        assert self.codec != ZDICT or dictionaries
+        self.threshold = threshold
+        # dictionaries: {..., crc: dictionary}
+        self.dictionaries = {crc32(dictionary): dictionary for dictionary in dictionaries}
+        self.dictionary = dictionaries[-1] if dictionaries else None
+        self.dict_id = crc32(self.dictionary) if dictionaries else 0
+
+    def encode(self, data: bytes) -> (int, bytes):
+        # 返回(flags, 数据)，压缩无收益时保持原样
+        if self.codec == RAW or len(data) < self.threshold:
+            return RAW, data
+        if self.codec == ZLIB:
+            result = zlib.compress(data)
+        elif self.codec == LZMA:
+            result = lzma.compress(data)
+        elif self.codec == BZ2:
+            result = bz2.compress(data)
+        else:
+            compressor = zlib.compressobj(zdict=self.dictionary)
+            result = ZDICT_HEAD.pack(self.dict_id) + compressor.compress(data) + compressor.flush()
+        return (self.codec, result) if len(result) < len(data) else (RAW, data)
+
+    def decode(self, flags: int, data: bytes) -> bytes:
+        return decompress(flags, data, self)
+
+
+def decompress(flags: int, data, codec: ValueCodec = None) -> bytes:
+    if flags == RAW:
+        return data
+    elif flags == ZLIB:
+        return zlib.decompress(data)
+    elif flags == LZMA:
+        return lzma.decompress(data)
+    elif flags == BZ2:
+        return bz2.decompress(data)
+    elif flags == ZDICT:
+        dictionary = codec and codec.dictionaries.get(ZDICT_HEAD.unpack_from(data)[0])
+        if dictionary is None:
+            raise ValueError('value compressed with an unknown dictionary')
+        return zlib.decompressobj(zdict=dictionary).decompress(data[ZDICT_HEAD.size:])
+    raise ValueError('unknown value codec %d' % flags)
+
+
 class ValueNode:
-    def __init__(self, key=None, value=None, file: FileIO = None):
+    # codec: 写入时的压缩设置，读取字典压缩的值时需要
+    def __init__(self, key=None, value=None, file: FileIO = None, codec: ValueCodec = None):
         self.ptr = 0
         self.size = 0
+        self.codec = codec
 
         if file is None:
             self.key = key
@@ -77,17 +350,41 @@ class ValueNode:
 
     def __bytes__(self):
         assert self.key is not None
+        data = dumps((self.key, self.value))
+        flags = RAW
+        if self.codec is not None:
+            flags, data = self.codec.encode(data)
         # 0删除 1正常
-        result = pack('B', 1) + dumps((self.key, self.value))
+        result = VALUE_HEAD.pack(1, flags, len(data)) + data
         self.size = len(result)
         return result
 
+    @staticmethod
+    def size_of(head: bytes) -> int:
+        # 由头部得到记录长度，旧格式为0
+        if head[1] == PICKLE_PROTO:
+            return 0
+        return VALUE_HEAD.size + VALUE_HEAD.unpack_from(head)[2]
+
     def load(self, file: FileIO):
-        self.ptr = file.tell()
-        indicator = file.read(1)
-        assert unpack('B', indicator)[0] in (0, 1)
-        self.key, self.value = load(file)
-        self.size = file.tell() - self.ptr
+        ptr = file.tell()
+        head = file.read(VALUE_HEAD.size)
+        assert head[0] in (0, 1)
+        # 旧格式: indicator + pickle
+        if head[1] == PICKLE_PROTO:
+            file.seek(ptr + 1)
+            self.key, self.value = load(file)
+            self.ptr = ptr
+            self.size = file.tell() - ptr
+        else:
+            self.loads(ptr, head + file.read(ValueNode.size_of(head) - VALUE_HEAD.size))
+
+    def loads(self, ptr: int, data: bytes):
+        self.ptr = ptr
+        indicator, flags, length = VALUE_HEAD.unpack_from(data)
+        assert indicator in (0, 1)
+        self.key, self.value = loads(decompress(flags, data[VALUE_HEAD.size:VALUE_HEAD.size + length], self.codec))
+        self.size = VALUE_HEAD.size + length
 
     def dump(self, file: FileIO):
         self.ptr = file.tell()
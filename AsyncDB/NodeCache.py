@@ -0,0 +1,73 @@
+from collections import OrderedDict
+
+from .Node import IndexNode
+from .TaskQue import memo_size
+
+
+class NodeCache:
+    # IndexNode的LRU缓存，按解码后的近似内存计量，与TaskQue保留的版本同一估计，内容与磁盘最新状态一致
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        # data: {..., ptr: node}
+        self.data = OrderedDict()
+        # 读取中的ptr: {..., ptr: ticket}
+        self.loading = {}
+        # 有命令未写入的ptr: {..., ptr: num}
+        self.pins = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, ptr: int) -> IndexNode:
+        node = self.data.get(ptr)
+        if node is not None:
+            self.hits += 1
+            self.data.move_to_end(ptr)
+        else:
+            self.misses += 1
+        return node
+
+    def ticket(self, ptr: int):
+        # 读取前领取，期间ptr被改动则作废
+        return self.loading.setdefault(ptr, object())
+
+    def put(self, ptr: int, node: IndexNode, ticket=None):
+        if ticket is not None:
+            if self.loading.get(ptr) is not ticket:
+                return
+            del self.loading[ptr]
+        # 磁盘内容尚未落定
+        size = memo_size(node)
+        if ptr in self.pins or ptr in self.data or size > self.max_size:
+            return
+
+        self.data[ptr] = node
+        self.size += size
+        while self.size > self.max_size:
+            _, old = self.data.popitem(last=False)
+            self.size -= memo_size(old)
+
+    def discard(self, ptr: int):
+        self.loading.pop(ptr, None)
+        node = self.data.pop(ptr, None)
+        if node is not None:
+            self.size -= memo_size(node)
+
+    def pin(self, ptr: int):
+        self.discard(ptr)
+        self.pins[ptr] = self.pins.get(ptr, 0) + 1
+
+    def unpin(self, ptr: int):
+        num = self.pins[ptr] - 1
+        if num:
+            self.pins[ptr] = num
+        else:
+            del self.pins[ptr]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0,
+                'entries': len(self.data), 'bytes': self.size}
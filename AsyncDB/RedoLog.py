@@ -0,0 +1,94 @@
+from os import remove
+from os.path import isfile
+from zlib import crc32
+from struct import Struct
+
+try:
+    from os import fdatasync
+except ImportError:
+    from os import fsync as fdatasync
+
+# 文件头: magic, generation
+LOG_HEAD = Struct('<4sQ')
+LOG_MAGIC = b'REDO'
+# 记录: 长度, crc, [..., (ptr, 长度, 数据)]
+REDO_HEAD = Struct('<II')
+WRITE_HEAD = Struct('<QI')
+# 写缓冲的日志记录使用的ptr，重做时不写入文件
+MEM_PTR = (1 << 64) - 1
+
+
+class RedoLog:
+    # 每个Task的全部写入在执行前追加为一条记录，写入队列排空时截断
+    def __init__(self, filename: str, gen: int):
+        self.filename = filename
+        self.file = open(filename, 'wb', buffering=0)
+        self.size = 0
+        # 累计写入，截断不清零
+        self.write_size = 0
+        # 已追加的记录数
+        self.seq = 0
+        self.truncate(gen)
+
+    def append(self, writes: list):
+        payload = b''.join(WRITE_HEAD.pack(ptr, len(data)) + data for ptr, data in writes)
+        record = REDO_HEAD.pack(len(payload), crc32(payload)) + payload
+        self.file.write(record)
+        self.size += len(record)
+        self.write_size += len(record)
+        self.seq += 1
+
+    def sync(self):
+        fdatasync(self.file.fileno())
+
+    def truncate(self, gen: int):
+        # generation与同时保存的空闲空间对应
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(LOG_HEAD.pack(LOG_MAGIC, gen))
+        self.size = 0
+
+    def close(self):
+        self.file.close()
+        remove(self.filename)
+
+    @staticmethod
+    def replay(file, filename: str):
+        # 按顺序重做完整的记录，返回(generation, [..., (ptr, size)], [..., 写缓冲的记录])
+        # 不存在日志返回None，文件头不完整时generation为None
+        if not isfile(filename):
+            return
+        gen = None
+        ranges = []
+        records = []
+        with open(filename, 'rb') as log:
+            head = log.read(LOG_HEAD.size)
+            if len(head) < LOG_HEAD.size:
+                return gen, ranges, records
+            magic, gen = LOG_HEAD.unpack(head)
+            if magic != LOG_MAGIC:
+                return None, ranges, records
+
+            while True:
+                head = log.read(REDO_HEAD.size)
+                if len(head) < REDO_HEAD.size:
+                    break
+                length, crc = REDO_HEAD.unpack(head)
+                payload = log.read(length)
+                if len(payload) < length or crc32(payload) != crc:
+                    break
+
+                payload = memoryview(payload)
+                offset = 0
+                while offset < length:
+                    ptr, size = WRITE_HEAD.unpack_from(payload, offset)
+                    offset += WRITE_HEAD.size
+                    if ptr == MEM_PTR:
+                        records.append(bytes(payload[offset:offset + size]))
+                        offset += size
+                        continue
+                    file.seek(ptr)
+                    file.write(payload[offset:offset + size])
+                    ranges.append((ptr, size))
+                    offset += size
+        return gen, ranges, records
@@ -1,113 +1,187 @@
 from bisect import bisect
-from collections import deque, namedtuple
+from collections import deque
 from collections.abc import Callable
+from time import monotonic
 
-Memo = namedtuple('Memo', 'head tail')
+# 旧版本占用的字节数上限，0为不限，仅约束读Task保留的版本，写入未完成的Task不受限
+MVCC_SIZE = 0
+# 读Task最后一次被加入后经过的秒数，不足时不中止
+ABORT_AGE = 0.5
+# 近似内存: 每个写Task，每个版本，节点中每个key连同其ptr
+TASK_SIZE = 512
+VERSION_SIZE = 64
+KEY_SIZE = 40
+
+
+class SnapshotTooOld(Exception):
+    # 旧版本超出上限时最早的读Task被中止，重试即可
+    pass
+
+
+def memo_size(memo) -> int:
+    # 节点按编码后的大小及key数估计，ptr及None不计
+    return 0 if memo is None or isinstance(memo, int) else memo.size + KEY_SIZE * len(memo.keys)
 
 
 class Task:
     # Query有对应Task，用于查询和清理映射
+    __slots__ = ('id', 'is_active', 'command_num', 'is_aborted', 'joined', 'ptrs', 'free_params')
+
     def __init__(self, task_id: int, is_active: bool, command_num=0):
         self.id = task_id
         self.is_active = is_active
         self.command_num = command_num
+        self.is_aborted = False
+        self.joined = 0
 
         if is_active:
             self.ptrs = []
-            # free_param: (ptr, size)
-            self.free_param = None
+            # free_params: [..., (ptr, size)]
+            self.free_params = []
 
     def __lt__(self, other: 'Task'):
         return self.id < other.id
 
 
+class Chain:
+    # 一个ptr的各版本，ids: [..., Task id]，memos: [..., head, tail]依次对应
+    # 同一Task的id为同一对象，各版本只占列表的槽位
+    __slots__ = ('ids', 'memos')
+
+    def __init__(self):
+        self.ids = []
+        self.memos = []
+
+
 class TaskQue:
     # 通过Queue确保异步下的ACID
-    def __init__(self):
+    def __init__(self, free: Callable, max_size=MVCC_SIZE):
+        self.free = free
+        self.max_size = max_size
         self.next_id = 0
         self.que = deque()
-        # virtual_map: {..., ptr: ([..., id], [..., memo])}
+        # virtual_map: {..., ptr: chain}
         self.virtual_map = {}
+        # 保留版本的近似字节数及其最大值
+        self.size = 0
+        self.size_max = 0
+        # 已中止但仍在读取的Task，期间释放的空间暂不复用: [..., free_param]
+        self.aborted = []
+        self.deferred = []
+        self.abort_num = 0
 
     def create(self, is_active: bool) -> Task:
         if is_active or not self.que or self.que[-1].is_active:
             token = Task(self.next_id, is_active)
             self.next_id += 1
             self.que.append(token)
+            if is_active:
+                self.size += TASK_SIZE
         else:
             token = self.que[-1]
+        if not is_active:
+            token.joined = monotonic()
         return token
 
     def set(self, token: Task, ptr: int, head, tail):
         if ptr == 0:
             return
 
-        memo = Memo(head, tail)
-        if ptr in self.virtual_map:
-            id_list, memo_list = self.virtual_map[ptr]
-        else:
-            id_list = []
-            memo_list = []
-            self.virtual_map[ptr] = (id_list, memo_list)
+        chain = self.virtual_map.get(ptr)
+        if chain is None:
+            chain = self.virtual_map[ptr] = Chain()
 
-        # 复用
-        if id_list and id_list[-1] == token.id:
-            memo_list[-1] = memo
+        # 复用，保留Task之前的head
+        if chain.ids and chain.ids[-1] == token.id:
+            chain.memos[-1] = tail
         else:
-            id_list.append(token.id)
-            memo_list.append(memo)
+            chain.ids.append(token.id)
+            chain.memos.append(head)
+            chain.memos.append(tail)
             token.ptrs.append(ptr)
+            self.size += VERSION_SIZE + memo_size(head)
+        if self.size > self.size_max:
+            self.size_max = self.size
 
     def get(self, token: Task, ptr: int, depend=0, is_active=True):
-        def get_depend_id():
-            if depend in self.virtual_map:
-                id_list, _ = self.virtual_map[depend]
-                index = bisect(id_list, token.id)
-                if index - 1 >= 0:
-                    return id_list[index - 1]
-                elif index < len(id_list):
-                    return id_list[index]
-            else:
-                return 0
-
+        def get_depend_range():
+            # depend为ptr所在节点，token所见版本由[begin, end)内的Task写入，其外的记录属于同一地址的其他节点
+            chain = self.virtual_map.get(depend)
+            if chain is None:
+                return 0, None
+            index = bisect(chain.ids, token.id)
+            return chain.ids[index - 1] if index else 0, chain.ids[index] if index < len(chain.ids) else None
+
+        if token.is_aborted:
+            raise SnapshotTooOld
         # 查询
-        if ptr in self.virtual_map:
-            depend_id = get_depend_id()
-            id_list, memo_list = self.virtual_map[ptr]
-            index = bisect(id_list, token.id)
+        chain = self.virtual_map.get(ptr)
+        if chain is not None:
+            begin, end = get_depend_range()
+            ids = chain.ids
+            index = bisect(ids, token.id)
 
             result = None
-            if index - 1 >= 0 and depend_id <= id_list[index - 1]:
-                result = memo_list[index - 1].tail
-            elif index < len(id_list) and depend_id <= id_list[index]:
-                result = memo_list[index].head
+            if index - 1 >= 0 and begin <= ids[index - 1]:
+                result = chain.memos[2 * index - 1]
+            elif index < len(ids) and begin <= ids[index] and (end is None or ids[index] < end):
+                result = chain.memos[2 * index]
 
             if is_active and not (isinstance(result, int) or result is None):
                 result = result.clone()
             return result
 
     def is_canceled(self, token: Task, ptr: int) -> bool:
-        if ptr in self.virtual_map:
-            id_list, memo_list = self.virtual_map[ptr]
-            if id_list[-1] > token.id or not memo_list[-1].tail:
+        chain = self.virtual_map.get(ptr)
+        if chain is not None:
+            if chain.ids[-1] > token.id or not chain.memos[-1]:
                 return True
 
+    def stats(self) -> dict:
+        # versions: 保留的各版本映射总数，oldest: 最早的Task之后创建的Task数
+        return {'tasks': len(self.que), 'ptrs': len(self.virtual_map),
+                'versions': sum(len(chain.ids) for chain in self.virtual_map.values()),
+                'bytes': self.size, 'bytes_max': self.size_max, 'max_size': self.max_size,
+                'oldest': self.next_id - self.que[0].id if self.que else 0,
+                'aborted': self.abort_num}
+
     def clean(self):
+        if self.aborted:
+            # 中止的Task读取结束后恢复空间复用
+            self.aborted = [token for token in self.aborted if token.command_num > 0]
+            if not self.aborted:
+                for param in self.deferred:
+                    self.free(*param)
+                self.deferred = []
+
         while self.que:
-            head = self.que.popleft()
+            head = self.que[0]
             if head.command_num > 0:
-                self.que.appendleft(head)
-                break
-            else:
-                if head.is_active:
-                    if isinstance(head.free_param, Callable):
-                        head.free_param()
-                    for ptr in head.ptrs:
-                        id_list, memo_list = self.virtual_map[ptr]
-                        del id_list[0]
-                        del memo_list[0]
-                        if not id_list:
-                            del self.virtual_map[ptr]
+                # 超出上限时中止最早的读Task，其余读Task及写入中的Task照常等待
+                # 刚加入的读取可能共享较早的读Task，等待ABORT_AGE后再中止
+                if head.is_active or not self.max_size or self.size <= self.max_size or \
+                        monotonic() - head.joined < ABORT_AGE:
+                    break
+                head.is_aborted = True
+                self.aborted.append(head)
+                self.abort_num += 1
+            self.que.popleft()
+
+            if head.is_active:
+                self.size -= TASK_SIZE
+                if self.aborted:
+                    self.deferred.extend(head.free_params)
+                else:
+                    for param in head.free_params:
+                        self.free(*param)
+                for ptr in head.ptrs:
+                    chain = self.virtual_map[ptr]
+                    self.size -= VERSION_SIZE + memo_size(chain.memos[0])
+                    del chain.ids[0]
+                    del chain.memos[:2]
+                    if not chain.ids:
+                        del self.virtual_map[ptr]
         else:
             # 重置
             self.next_id = 0
+            self.size = 0
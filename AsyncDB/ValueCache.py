@@ -0,0 +1,84 @@
+from collections import OrderedDict
+from sys import getsizeof
+
+# get未命中
+NOT_CACHED = object()
+# 已知不存在的key，与存储的None区分
+MISSING = object()
+
+
+def sizeof(obj) -> int:
+    # 近似内存占用，递归计算常见容器
+    size = getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(key) + sizeof(value) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(map(sizeof, obj))
+    return size
+
+
+class ValueCache:
+    # 值的LRU缓存，按字节计量，与最新写入一致，不存在的key缓存为MISSING
+    def __init__(self, max_size=16 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        # data: {..., key: (value, size)}
+        self.data = OrderedDict()
+        # 读取中的key: {..., key: ticket}
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            self.misses += 1
+            return NOT_CACHED
+        self.hits += 1
+        self.data.move_to_end(key)
+        return entry[0]
+
+    def peek(self, key):
+        # 不计入命中，不改变顺序
+        entry = self.data.get(key)
+        return NOT_CACHED if entry is None else entry[0]
+
+    def ticket(self, key):
+        # 读取前领取，期间key被写入则作废
+        return self.loading.setdefault(key, object())
+
+    def put(self, key, value, ticket=None):
+        if ticket is not None:
+            if self.loading.get(key) is not ticket:
+                return
+            del self.loading[key]
+        else:
+            self.loading.pop(key, None)
+        self.discard(key)
+
+        size = sizeof(key) + sizeof(value)
+        if size > self.max_size:
+            return
+        self.data[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, old) = self.data.popitem(last=False)
+            self.size -= old
+
+    def discard(self, key):
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self.data.clear()
+        self.loading.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0,
+                'entries': len(self.data), 'bytes': self.size}
@@ -1 +1,3 @@
 from .AsyncDB import AsyncDB
+from .Node import train_dictionary
+from .TaskQue import SnapshotTooOld
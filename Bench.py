@@ -0,0 +1,230 @@
+from argparse import ArgumentParser
+from asyncio import gather, get_event_loop
+from json import dump, load
+from os import remove
+from os.path import getsize, isfile
+from platform import platform, python_version
+from random import randint, random, sample, seed, shuffle
+from time import perf_counter, strftime
+
+from AsyncDB import AsyncDB
+from AsyncDB.Engine import MEMTABLE_SIZE, MIN_DEGREE
+
+FILE = 'Bench.db'
+# 默认key数，值长度
+N = 20000
+VALUE_SIZE = 100
+SCAN_LENS = (10, 100, 1000)
+VALUE_SIZES = (16, 256, 4096, 65536)
+# 单次写入的数据量上限
+SWEEP_BYTES = 64 * 1024 * 1024
+SCALES = (1, 4, 16)
+# 混合负载的并发数及写入比例
+WORKERS = 32
+WRITE_RATIO = 0.1
+# 反复覆盖的热点key数
+HOT_KEYS = 16
+# 新建文件的degree，由-d指定；写缓冲大小，由-m指定
+min_degree = MIN_DEGREE
+memtable_size = MEMTABLE_SIZE
+
+
+def clean():
+    for suffix in ('', '.redo', '.free', '.bloom', '.dict', '.compact', '.compact.redo', '.compact.free'):
+        if isfile(FILE + suffix):
+            remove(FILE + suffix)
+
+
+def open_db() -> AsyncDB:
+    # 不使用值缓存，测得的是树本身
+    return AsyncDB(FILE, value_cache_size=0, metrics=False, min_degree=min_degree, memtable_size=memtable_size)
+
+
+class Recorder:
+    # 记录一项负载的耗时、写入量与文件增长
+    def __init__(self, db: AsyncDB):
+        self.db = db
+        self.latencies = []
+        self.write_size = db.engine.written()
+        self.file_size = getsize(FILE)
+        self.begin = perf_counter()
+
+    async def finish(self) -> dict:
+        # 计入写缓冲写入树及写入落盘的时间
+        self.db.flush()
+        await self.db.engine.drain()
+        elapsed = perf_counter() - self.begin
+        ops = len(self.latencies)
+        latencies = sorted(self.latencies)
+        written = self.db.engine.written() - self.write_size
+        await self.db.close()
+        return {'ops': ops, 'ops/s': round(ops / elapsed),
+                'p50_us': round(latencies[ops // 2] * 1000000, 1),
+                'p99_us': round(latencies[min(ops * 99 // 100, ops - 1)] * 1000000, 1),
+                'bytes/op': round(written / ops, 1), 'growth': getsize(FILE) - self.file_size}
+
+
+async def insert(keys, value_size=VALUE_SIZE) -> dict:
+    clean()
+    db = open_db()
+    recorder = Recorder(db)
+    value = 'v' * value_size
+    for key in keys:
+        begin = perf_counter()
+        db[key] = value
+        recorder.latencies.append(perf_counter() - begin)
+    return await recorder.finish()
+
+
+async def get(keys) -> dict:
+    db = open_db()
+    recorder = Recorder(db)
+    for key in keys:
+        begin = perf_counter()
+        await db[key]
+        recorder.latencies.append(perf_counter() - begin)
+    return await recorder.finish()
+
+
+async def overwrite(keys) -> dict:
+    db = open_db()
+    recorder = Recorder(db)
+    for key in keys:
+        begin = perf_counter()
+        db[key] = 'w' * VALUE_SIZE
+        recorder.latencies.append(perf_counter() - begin)
+    return await recorder.finish()
+
+
+async def hot(n: int) -> dict:
+    # 少数key反复写入不同的值
+    db = open_db()
+    recorder = Recorder(db)
+    for i in range(n):
+        begin = perf_counter()
+        db[randint(0, HOT_KEYS - 1)] = str(i).rjust(VALUE_SIZE)
+        recorder.latencies.append(perf_counter() - begin)
+    return await recorder.finish()
+
+
+async def pop(keys) -> dict:
+    db = open_db()
+    recorder = Recorder(db)
+    for key in keys:
+        begin = perf_counter()
+        db.pop(key)
+        recorder.latencies.append(perf_counter() - begin)
+    return await recorder.finish()
+
+
+async def scan(n: int, max_len: int) -> dict:
+    db = open_db()
+    recorder = Recorder(db)
+    for _ in range(max(n // max_len, 100)):
+        begin = perf_counter()
+        await db.items(randint(0, n - 1), max_len=max_len)
+        recorder.latencies.append(perf_counter() - begin)
+    return await recorder.finish()
+
+
+async def mixed(n: int) -> dict:
+    # WORKERS个协程并发读写
+    db = open_db()
+    recorder = Recorder(db)
+
+    async def worker(num: int):
+        for _ in range(num):
+            key = randint(0, n - 1)
+            begin = perf_counter()
+            if random() < WRITE_RATIO:
+                db[key] = 'm' * VALUE_SIZE
+            else:
+                await db[key]
+            recorder.latencies.append(perf_counter() - begin)
+
+    await gather(*(worker(n // WORKERS) for _ in range(WORKERS)))
+    return await recorder.finish()
+
+
+async def run(n: int) -> dict:
+    results = {}
+
+    def report(name: str, result: dict):
+        results[name] = result
+        print(name.ljust(20), ' '.join('%s=%s' % item for item in result.items()), flush=True)
+
+    seed(0)
+    keys = list(range(n))
+    shuffled = sample(keys, n)
+    report('insert_seq', await insert(keys))
+    report('insert_random', await insert(shuffled))
+    report('get_hit', await get(sample(keys, n)))
+    report('get_miss', await get([key + 0.5 for key in sample(keys, n)]))
+    report('overwrite', await overwrite(sample(keys, n)))
+    report('overwrite_hot', await hot(n))
+    for max_len in SCAN_LENS:
+        report('scan_%d' % max_len, await scan(n, max_len))
+    report('mixed', await mixed(n))
+    report('pop', await pop(sample(keys, n)))
+
+    for value_size in VALUE_SIZES:
+        num = min(n, SWEEP_BYTES // value_size)
+        report('value_%d' % value_size, await insert(shuffled[:num], value_size))
+
+    for scale in SCALES:
+        num = n * scale // SCALES[1]
+        scaled = list(range(num))
+        shuffle(scaled)
+        report('insert_%d' % num, await insert(scaled))
+        report('get_%d' % num, await get(sample(scaled, min(num, n))))
+    clean()
+    return results
+
+
+def compare(old_file: str, new_file: str):
+    # 按负载对比吞吐与p99，变化为new相对old
+    with open(old_file) as file:
+        old = load(file)
+    with open(new_file) as file:
+        new = load(file)
+    print('workload'.ljust(20), 'old ops/s'.rjust(10), 'new ops/s'.rjust(10), 'change'.rjust(8),
+          'old p99'.rjust(10), 'new p99'.rjust(10), 'change'.rjust(8))
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if before is None:
+            continue
+        print(name.ljust(20), str(before['ops/s']).rjust(10), str(result['ops/s']).rjust(10),
+              ('%+.1f%%' % ((result['ops/s'] / before['ops/s'] - 1) * 100)).rjust(8),
+              str(before['p99_us']).rjust(10), str(result['p99_us']).rjust(10),
+              ('%+.1f%%' % ((result['p99_us'] / before['p99_us'] - 1) * 100 if before['p99_us'] else 0)).rjust(8))
+
+
+def main():
+    parser = ArgumentParser(description='AsyncDB benchmark')
+    parser.add_argument('-n', type=int, default=N, help='keys per workload')
+    parser.add_argument('-d', '--min-degree', type=int, default=MIN_DEGREE, help='B-Tree degree of new files')
+    parser.add_argument('-m', '--memtable-size', type=int, default=MEMTABLE_SIZE, help='write buffer bytes, 0 for none')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs, each workload keeps its median')
+    parser.add_argument('-o', '--output', help='save results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved runs')
+    args = parser.parse_args()
+    global min_degree, memtable_size
+    min_degree = args.min_degree
+    memtable_size = args.memtable_size
+
+    if args.compare:
+        return compare(*args.compare)
+    runs = []
+    for i in range(args.repeat):
+        print('run', i + 1, flush=True)
+        runs.append(get_event_loop().run_until_complete(run(args.n)))
+    results = {name: sorted((result[name] for result in runs), key=lambda result: result['ops/s'])[args.repeat // 2]
+               for name in runs[0]}
+    if args.output:
+        with open(args.output, 'w') as file:
+            dump({'time': strftime('%Y-%m-%d %H:%M:%S'), 'python': python_version(), 'platform': platform(),
+                  'n': args.n, 'min_degree': min_degree, 'memtable_size': memtable_size, 'repeat': args.repeat, 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,12 @@ async def write():
         print('set', i)
 
 
+async def bulk():
+    db = AsyncDB(FILE)
+    db.bulk_load((i, i) for i in range(M))
+    await db.close()
+
+
 async def read():
     db = AsyncDB(FILE)
     for i in range(M):
@@ -23,6 +29,7 @@ async def read():
 def main():
     loop = get_event_loop()
     loop.run_until_complete(write())
+    # loop.run_until_complete(bulk())
     # loop.run_until_complete(read())
 
 
@@ -1,15 +1,62 @@
-from asyncio import get_event_loop, sleep, ensure_future
-from os import remove
-from os.path import isfile
-from random import randint
+from ast import literal_eval
+from asyncio import get_event_loop, sleep, ensure_future, gather, wait_for, TimeoutError
+from os import remove, replace, _exit
+from os.path import getsize, isfile
+from random import randint, seed
+from shutil import copy
+from subprocess import run
+from sys import argv, executable
 
-from AsyncDB import AsyncDB
+from AsyncDB import AsyncDB, SnapshotTooOld, train_dictionary
 
 T = 10000
 M = 10000
 FILE = 'Test.db'
 
 
+def clean():
+    # 含修复中断时留下的临时文件
+    for name in ('__' + FILE, '$__' + FILE):
+        if isfile(name):
+            remove(name)
+    for suffix in ('', '.redo', '.free', '.bloom', '.dict', '.compact', '.compact.redo', '.compact.free'):
+        if isfile(FILE + suffix):
+            remove(FILE + suffix)
+
+
+def crash_ops(rand_seed: int) -> list:
+    # 同一seed得到相同的写入: [..., {..., key: value OR None}]，None为删除，多项的作为一个batch
+    seed(rand_seed)
+    ops = []
+    for i in range(T):
+        size = 10 if randint(0, 50) == 0 else 1
+        # 少数值较长，设置inline_size时在内联与ValueNode间转换
+        value = 'v%d' % i if randint(0, 4) else 'v%d' % i * 20
+        ops.append({randint(0, M): None if randint(0, 3) == 0 else value for _ in range(size)})
+    return ops
+
+
+async def crash_child(rand_seed: int, config: dict):
+    # 写入后不close直接退出
+    db = AsyncDB(FILE, durability='group', **config)
+    for op in crash_ops(rand_seed):
+        if len(op) > 1:
+            with db.write_batch() as batch:
+                for key, value in op.items():
+                    if value is None:
+                        batch.pop(key)
+                    else:
+                        batch[key] = value
+        else:
+            for key, value in op.items():
+                if value is None:
+                    db.pop(key)
+                else:
+                    db[key] = value
+    await db.sync()
+    _exit(0)
+
+
 async def acid_t():
     if isfile(FILE):
         remove(FILE)
@@ -82,8 +129,502 @@ async def acid_t():
     print('ACID OK')
 
 
+async def crash_t(config=None, without_redo=False):
+    # config: 两次打开共用的参数，without_redo: 删除redo日志，由扫描文件修复
+    clean()
+    config = config or {}
+    rand_seed = randint(0, M)
+    assert run([executable, __file__, 'crash', str(rand_seed), repr(config)]).returncode == 0
+    std = {}
+    for op in crash_ops(rand_seed):
+        for key, value in op.items():
+            if value is None:
+                std.pop(key, None)
+            else:
+                std[key] = value
+    std = sorted(std.items())
+
+    # 重做日志恢复
+    if without_redo:
+        remove(FILE + '.redo')
+    db = AsyncDB(FILE, **config)
+    assert await db.items() == std
+    for key, value in std[:100]:
+        assert await db[key] == value
+    await db.close()
+    db = AsyncDB(FILE, **config)
+    assert await db.items() == std
+    await db.close()
+    print('crash OK', *config, 'without redo' if without_redo else '')
+
+
+async def batch_t():
+    clean()
+    db = AsyncDB(FILE)
+    std = {}
+    db.set_many((i, i) for i in range(0, M, 2))
+    std.update((i, i) for i in range(0, M, 2))
+    with db.write_batch() as batch:
+        for i in range(0, M, 3):
+            if i % 2:
+                std[i] = batch[i] = -i
+            else:
+                std.pop(i, None)
+                batch.pop(i)
+    # 异常时不提交
+    try:
+        with db.write_batch() as batch:
+            batch[-1] = -1
+            raise KeyError
+    except KeyError:
+        pass
+    assert await db[-1] is None
+    std_items = sorted(std.items())
+    assert await db.items() == std_items
+    print('batch OK')
+
+    # 分页遍历
+    assert [item async for item in db.scan(page_size=randint(1, 100))] == std_items
+    assert [item async for item in db.scan(reverse=True, prefetch=0)] == std_items[::-1]
+    lo, hi = std_items[100][0], std_items[-100][0]
+    assert [item async for item in db.scan(lo, hi, page_size=7)] == std_items[100:-99]
+    # 中途退出后由continuation继续
+    result = []
+    async with db.scan(page_size=10) as scan:
+        async for item in scan:
+            result.append(item)
+            if len(result) == 55:
+                break
+    async for item in db.scan(after=scan.continuation, page_size=10):
+        result.append(item)
+    assert result == std_items
+    await db.close()
+    print('scan OK')
+
+
+async def regression_t():
+    clean()
+    db = AsyncDB(FILE)
+
+    # 存储None: 未命中及删除后均可写入
+    assert await db['a'] is None
+    db['a'] = None
+    db['b'] = 1
+    db.pop('b')
+    db['b'] = None
+    assert await db.items() == [('a', None), ('b', None)]
+    db.pop('a')
+    db.pop('b')
+
+    for i in range(M):
+        db[i] = str(i)
+    await db.close()
+
+    # 首个读取取消后，共享读取的其余读取正常返回
+    db = AsyncDB(FILE, value_cache_size=0, node_cache_size=0)
+    for key in range(0, M, 97):
+        first = ensure_future(db[key])
+        rest = [ensure_future(db[key]) for _ in range(3)]
+        await sleep(0)
+        first.cancel()
+        assert await gather(*rest) == [str(key)] * 3
+        try:
+            await wait_for(db[key + 1], 0)
+        except TimeoutError:
+            pass
+    print('cancel OK')
+
+    # 持续并发读取时整理仍能完成
+    is_done = False
+
+    async def reader():
+        while not is_done:
+            rand_key = randint(0, M - 1)
+            assert await db[rand_key] == str(rand_key)
+            await sleep(0)
+
+    readers = [ensure_future(reader()) for _ in range(16)]
+    await wait_for(db.compact(rate=0), 30)
+    is_done = True
+    await gather(*readers)
+    assert await db.items() == sorted((i, str(i)) for i in range(M))
+    await db.close()
+    print('regression OK')
+
+
+async def get_many_t():
+    # 结果与keys顺序一致，重复及不存在的key，部分命中缓存，写入进行中
+    clean()
+    db = AsyncDB(FILE)
+    std = {}
+    assert await db.get_many([]) == []
+    for i in range(T):
+        rand_key = randint(0, M)
+        if randint(0, 3) == 0:
+            assert db.pop(rand_key) == std.pop(rand_key, None)
+        else:
+            std[rand_key] = db[rand_key] = i
+        if randint(0, 50) == 0:
+            keys = [randint(-10, M + 10) for _ in range(randint(1, 200))]
+            keys += keys[:10]
+            for key in keys[:20]:
+                await db[key]
+            assert await db.get_many(keys) == [std.get(key) for key in keys]
+    keys = list(range(-10, M + 10))
+    assert await db.get_many(reversed(keys)) == [std.get(key) for key in reversed(keys)]
+    await db.close()
+    print('get_many OK')
+
+
+async def free_t():
+    # 重开后沿用保存的空闲空间，与遍历树所得一致，不属于同一文件状态的记录被忽略
+    clean()
+    db = AsyncDB(FILE)
+    std = {}
+    for i in range(M):
+        std[i] = db[i] = 'v%d' % i
+    for i in range(0, M, 2):
+        db.pop(i)
+        del std[i]
+    await db.close()
+    copy(FILE + '.free', FILE + '.free.old')
+
+    db = AsyncDB(FILE)
+    free_bytes = db.engine.allocator_stats()['free_bytes']
+    assert free_bytes > 0
+    assert db.engine.allocator.extents() == db.engine.walk_extents()
+    size = getsize(FILE)
+    for i in range(0, M, 2):
+        std[i] = db[i] = 'w%d' % i
+    assert db.engine.allocator_stats()['reused'] > 0
+    await db.close()
+    assert getsize(FILE) - size < free_bytes
+
+    # 旧记录不可用，重建后写入不覆盖现有数据
+    replace(FILE + '.free.old', FILE + '.free')
+    db = AsyncDB(FILE)
+    assert db.engine.allocator.extents() == db.engine.walk_extents()
+    for i in range(1, M, 2):
+        std[i] = db[i] = 'x%d' % i
+    assert await db.items() == sorted(std.items())
+    await db.close()
+    print('free OK')
+
+
+async def bulk_t():
+    # 离线构建及空库导入得到的树可继续读写
+    std_items = [(i, 'v%d' % i * randint(1, 10)) for i in range(0, M, 3)]
+    for build in (True, False):
+        clean()
+        if build:
+            AsyncDB.build(FILE, iter(std_items), inline_size=32, fill=0.7, min_degree=8)
+            db = AsyncDB(FILE, inline_size=32)
+            assert db.engine.min_degree == 8
+        else:
+            db = AsyncDB(FILE, inline_size=32)
+            db.bulk_load(iter(std_items), fill=0.7)
+        assert await db.items() == std_items
+        for key, value in std_items[:100]:
+            assert await db[key] == value
+
+        std = dict(std_items)
+        for i in range(T):
+            rand_key = randint(0, M)
+            if randint(0, 3) == 0:
+                assert db.pop(rand_key) == std.pop(rand_key, None)
+            else:
+                std[rand_key] = db[rand_key] = i
+        assert await db.items() == sorted(std.items())
+        await db.close()
+        db = AsyncDB(FILE)
+        assert await db.items() == sorted(std.items())
+        await db.close()
+
+    # 非空或乱序的输入
+    clean()
+    db = AsyncDB(FILE)
+    db[0] = 0
+    is_rejected = False
+    try:
+        db.bulk_load(iter(std_items))
+    except AssertionError:
+        is_rejected = True
+    assert is_rejected
+    await db.close()
+    clean()
+    is_rejected = False
+    try:
+        AsyncDB.build(FILE, iter([(1, 1), (0, 0)]))
+    except AssertionError:
+        is_rejected = True
+    assert is_rejected
+    print('bulk OK')
+
+
+async def bloom_t():
+    # filter只排除不存在的key，重建期间及关闭重开后结果不变
+    clean()
+    db = AsyncDB(FILE, use_bloom=True, value_cache_size=0)
+    std = {}
+    for i in range(T):
+        rand_key = randint(0, M)
+        if randint(0, 2) == 0:
+            assert db.pop(rand_key) == std.pop(rand_key, None)
+        else:
+            std[rand_key] = db[rand_key] = i
+        if randint(0, 100) == 0:
+            keys = [randint(0, 2 * M) for _ in range(20)]
+            assert await db.get_many(keys) == [std.get(key) for key in keys]
+    for key in range(2 * M):
+        assert await db[key] == std.get(key)
+    await db.close()
+    assert isfile(FILE + '.bloom')
+
+    db = AsyncDB(FILE, use_bloom=True, value_cache_size=0)
+    assert db.engine.bloom is not None and db.engine.bloom_task is None
+    for key in range(2 * M):
+        assert await db[key] == std.get(key)
+    await db.close()
+    print('bloom OK')
+
+
+async def inline_t():
+    # 值在内联与ValueNode间反复转换，分裂合并时内联值移入内部节点
+    clean()
+    db = AsyncDB(FILE, inline_size=32, value_cache_size=0)
+    std = {}
+    for i in range(T):
+        rand_key = randint(0, M)
+        if randint(0, 3) == 0:
+            assert db.pop(rand_key) == std.pop(rand_key, None)
+        else:
+            std[rand_key] = db[rand_key] = 'v%d' % i * randint(1, 10)
+    std_items = sorted(std.items())
+    assert await db.items() == std_items
+    keys = [randint(0, M) for _ in range(100)]
+    assert await db.get_many(keys) == [std.get(key) for key in keys]
+    await db.compact(rate=0)
+    await db.close()
+    db = AsyncDB(FILE, inline_size=32)
+    assert await db.items() == std_items
+    for key, value in std_items[:100]:
+        assert await db[key] == value
+    await db.close()
+    print('inline OK')
+
+
+async def mmap_t():
+    # 映射随文件增长重新建立，整理替换文件后仍读到新文件
+    clean()
+    db = AsyncDB(FILE, use_mmap=True, value_cache_size=0)
+    std = {}
+    for i in range(T):
+        rand_key = randint(0, M)
+        if randint(0, 3) == 0:
+            assert db.pop(rand_key) == std.pop(rand_key, None)
+        else:
+            std[rand_key] = db[rand_key] = 'v%d' % i * randint(1, 10)
+        if randint(0, 100) == 0:
+            rand_key = randint(0, M)
+            assert await db[rand_key] == std.get(rand_key)
+    assert db.engine.async_file.map is not None
+    assert await db.items() == sorted(std.items())
+    await db.compact(rate=0)
+    for key in list(std)[:100]:
+        assert await db[key] == std[key]
+    await db.close()
+    db = AsyncDB(FILE, use_mmap=True)
+    assert await db.items() == sorted(std.items())
+    await db.close()
+    print('mmap OK')
+
+
+async def degree_t():
+    # 小min_degree下分裂合并频繁，并发读取只应看到某次写入前后的值
+    for min_degree in (2, 4):
+        clean()
+        db = AsyncDB(FILE, min_degree=min_degree, value_cache_size=0)
+        std = {}
+        history = {}
+        is_done = False
+
+        async def reader():
+            while not is_done:
+                rand_key = randint(0, 500)
+                values = history.setdefault(rand_key, [std.get(rand_key)])
+                begin = len(values) - 1
+                assert await db[rand_key] in values[begin:]
+                if randint(0, 20) == 0:
+                    keys = [key for key, _ in await db.items(randint(0, 250), randint(250, 500))]
+                    assert keys == sorted(keys)
+
+        readers = [ensure_future(reader()) for _ in range(8)]
+        for i in range(T):
+            rand_key = randint(0, 500)
+            if randint(0, 4) < 2:
+                std.pop(rand_key, None)
+                db.pop(rand_key)
+                history.setdefault(rand_key, []).append(None)
+            else:
+                std[rand_key] = db[rand_key] = i
+                history.setdefault(rand_key, []).append(i)
+            if randint(0, 5) == 0:
+                await sleep(0)
+        is_done = True
+        await gather(*readers)
+        assert await db.items() == sorted(std.items())
+        await db.close()
+
+    # 已有文件以文件头记录的min_degree为准，整理时可改变
+    db = AsyncDB(FILE, min_degree=64)
+    assert db.engine.min_degree == 4
+    await db.compact(rate=0, min_degree=16)
+    assert db.engine.min_degree == 16
+    assert await db.items() == sorted(std.items())
+    await db.close()
+    db = AsyncDB(FILE)
+    assert db.engine.min_degree == 16
+    assert await db.items() == sorted(std.items())
+    await db.close()
+    print('min_degree OK')
+
+
+async def compress_t():
+    # 各压缩方式写入的值在改变设置及重开后均可读取，字典保存于.dict
+    clean()
+    std = {}
+    samples = ['value %d of a small record' % i for i in range(100)]
+    configs = [{'compression': name, 'compress_size': 16} for name in ('zlib', 'lzma', 'bz2')]
+    configs.append({'value_dict': train_dictionary(samples), 'compress_size': 16})
+    for config in configs:
+        db = AsyncDB(FILE, value_cache_size=0, **config)
+        for i in range(M // 10):
+            rand_key = randint(0, M)
+            std[rand_key] = db[rand_key] = 'value %d of a small record' % i * randint(1, 5)
+        assert await db.items() == sorted(std.items())
+        await db.close()
+    assert isfile(FILE + '.dict')
+
+    db = AsyncDB(FILE, value_cache_size=0)
+    assert await db.items() == sorted(std.items())
+    await db.compact(rate=0)
+    for key in list(std)[:100]:
+        assert await db[key] == std[key]
+    await db.close()
+    print('compress OK')
+
+
+async def memtable_t():
+    # 缓冲中的写入及删除对各读取可见，写入树前后结果一致
+    clean()
+    db = AsyncDB(FILE, memtable_size=4096, value_cache_size=0)
+    std = {}
+    for i in range(T):
+        rand_key = randint(0, M)
+        op = randint(0, 5)
+        if op == 0:
+            assert db.pop(rand_key) == std.pop(rand_key, None)
+        elif op == 1:
+            with db.write_batch() as batch:
+                for key in (randint(0, M) for _ in range(5)):
+                    if randint(0, 2) == 0:
+                        std.pop(key, None)
+                        batch.pop(key)
+                    else:
+                        std[key] = batch[key] = -i
+        else:
+            std[rand_key] = db[rand_key] = i
+        if randint(0, 100) == 0:
+            lo = randint(0, M)
+            hi = lo + randint(0, 100)
+            assert await db.items(lo, hi) == sorted((key, value) for key, value in std.items() if lo <= key <= hi)
+            keys = [randint(0, M) for _ in range(20)]
+            assert await db.get_many(keys) == [std.get(key) for key in keys]
+            assert await db[rand_key] == std.get(rand_key)
+        if randint(0, 1000) == 0:
+            db.flush()
+    assert db.engine.memtable
+    assert await db.items() == sorted(std.items())
+    await db.compact(rate=0)
+    assert await db.items() == sorted(std.items())
+    await db.close()
+    db = AsyncDB(FILE)
+    assert await db.items() == sorted(std.items())
+    await db.close()
+    print('memtable OK')
+
+
+async def mvcc_t():
+    # 旧版本超出mvcc_size时中止最早的读取，重试得到之后的结果，scan的页自动重试
+    clean()
+    db = AsyncDB(FILE, mvcc_size=64 * 1024, value_cache_size=0, node_cache_size=0)
+    std = {}
+    for i in range(M):
+        std[i] = db[i] = i
+    engine = db.engine
+    read_node = engine.read_node
+
+    async def slow_read(ptr):
+        await sleep(0.01)
+        return await read_node(ptr)
+
+    async def scan_all():
+        return [item async for item in db.scan(page_size=M)]
+
+    engine.read_node = slow_read
+    reading = ensure_future(db.items())
+    while not reading.done():
+        rand_key = randint(0, M - 1)
+        std[rand_key] = db[rand_key] = -rand_key
+        await sleep(0.001)
+    is_aborted = False
+    try:
+        await reading
+    except SnapshotTooOld:
+        is_aborted = True
+    assert is_aborted
+    assert await db.items() == sorted(std.items())
+
+    # 整页读取同样被中止，写入停止后重试完成
+    abort_num = engine.task_que.abort_num
+    scanning = ensure_future(scan_all())
+    while not scanning.done() and engine.task_que.abort_num == abort_num:
+        rand_key = randint(0, M - 1)
+        std[rand_key] = db[rand_key] = rand_key
+        await sleep(0.001)
+    assert await scanning == sorted(std.items())
+    assert engine.task_que.abort_num > abort_num
+    engine.read_node = read_node
+    await db.close()
+    print('mvcc OK')
+
+
 def main():
     loop = get_event_loop()
+    if argv[1:2] == ['crash']:
+        loop.run_until_complete(crash_child(int(argv[2]), literal_eval(argv[3])))
+    loop.run_until_complete(crash_t())
+    loop.run_until_complete(crash_t({'use_mmap': True}))
+    loop.run_until_complete(crash_t({'inline_size': 64}))
+    loop.run_until_complete(crash_t({'inline_size': 64}, without_redo=True))
+    loop.run_until_complete(crash_t({'use_bloom': True}))
+    loop.run_until_complete(crash_t({'min_degree': 4}))
+    loop.run_until_complete(crash_t({'compression': 'zlib', 'compress_size': 16}))
+    loop.run_until_complete(crash_t({'value_dict': b'v0123456789' * 10, 'compress_size': 16}, without_redo=True))
+    loop.run_until_complete(crash_t({'memtable_size': 4096}))
+    loop.run_until_complete(batch_t())
+    loop.run_until_complete(regression_t())
+    loop.run_until_complete(mmap_t())
+    loop.run_until_complete(inline_t())
+    loop.run_until_complete(bloom_t())
+    loop.run_until_complete(bulk_t())
+    loop.run_until_complete(free_t())
+    loop.run_until_complete(get_many_t())
+    loop.run_until_complete(degree_t())
+    loop.run_until_complete(compress_t())
+    loop.run_until_complete(memtable_t())
+    loop.run_until_complete(mvcc_t())
+    clean()
     for i in range(1000):
         loop.run_until_complete(acid_t())
         remove(FILE)